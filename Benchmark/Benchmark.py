@@ -0,0 +1,436 @@
+from argparse import ArgumentParser, SUPPRESS
+import subprocess
+import importlib
+import random
+import codecs
+import time
+import sys
+import os
+
+# Number of records of the real files, the synthetic inputs are generated
+# with these sizes multiplied by the scale factor
+base_records = {
+    "jmdict": 200000,
+    "jmnedict": 740000,
+    "kanjidic2": 13000,
+    "kanjivg": 11000,
+    "radkfile": 13000,
+    "kradfile": 13000
+    }
+
+# Converter script, command line arguments and input files of every benchmark
+converters = {
+    "jmdict": ("JMdictToSQLite", [("--jmdictfile", "JMdict_e")]),
+    "jmnedict": ("JMnedictToSQLite", [("--jmnedictfile", "JMnedict.xml")]),
+    "kanjidic2": ("Kanjidic2ToSQLite", [("--kanjidic2file", "kanjidic2.xml")]),
+    "kanjivg": ("KanjiVGToSQLite", [("--kanjivgfile", "kanjivg.xml")]),
+    "radkfile": ("RadkfileToSQLite", [("--radkfile", "radkfile"), ("--radkfile2", "radkfile2")]),
+    "kradfile": ("KradfileToSQLite", [("--kradfile", "kradfile"), ("--kradfile2", "kradfile2")])
+    }
+
+entities = [
+    ("n", "noun (common) (futsuumeishi)"),
+    ("v1", "Ichidan verb"),
+    ("adj-i", "adjective (keiyoushi)"),
+    ("uk", "word usually written using kana alone"),
+    ("ateji", "ateji (phonetic) reading"),
+    ("comp", "computing"),
+    ("ksb", "Kansai-ben"),
+    ("surname", "family or surname"),
+    ("place", "place name"),
+    ("given", "given name or forename, gender not specified")
+    ]
+
+# Rows collected by the parsers before each (ignored) write with --parseonly,
+# as the default --batchsize of the converters
+parse_batch_size = 10000
+
+words = "water fire tree house river mountain person walk run eat see big small red blue bright clear obvious".split()
+hiragana = [chr(code) for code in range(0x3041, 0x3094)]
+katakana = [chr(code) for code in range(0x30a1, 0x30f5)]
+kanji = []
+radicals = []
+
+
+def parse_cmdline():
+    parser = ArgumentParser()
+    parser.add_argument("--scale", help="size of the synthetic inputs compared to the real files (ex. 0.1)", type=float, default=0.05)
+    parser.add_argument("--workdir", help="directory where inputs and databases are created", default="benchmark")
+    parser.add_argument("--converters", help="comma separated list of converters to run (default all)", default=",".join(converters))
+    parser.add_argument("--parseonly", help="only parse the inputs without writing any database", action="store_true")
+    parser.add_argument("--fastbuild", "--fast-build", help="run the converters with --fastbuild", action="store_true")
+    parser.add_argument("--seed", help="seed of the synthetic data generator", type=int, default=1)
+    parser.add_argument("--parse", help=SUPPRESS, nargs=2)
+    return parser.parse_args()
+
+
+def init_characters():
+    # Radkfile and kradfile are EUC-JP files so only kanji having an
+    # EUC-JP encoding can be used
+    for code in range(0x4e00, 0x9fa0):
+        try:
+            chr(code).encode("euc-jp")
+        except UnicodeEncodeError:
+            continue
+        kanji.append(chr(code))
+
+    radicals.extend(kanji[-253:])
+    del kanji[-253:]
+
+
+def kanji_word(rnd):
+    return "".join(rnd.choice(kanji) for i in range(rnd.randint(1, 3)))
+
+
+def kana_word(rnd):
+    if rnd.random() < 0.2:
+        return "".join(rnd.choice(katakana) for i in range(rnd.randint(2, 5))) + "ー"
+    return "".join(rnd.choice(hiragana) for i in range(rnd.randint(2, 5)))
+
+
+def entity(rnd):
+    return "&" + rnd.choice(entities)[0] + ";"
+
+
+def write_dtd_header(file, root):
+    file.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
+    file.write("<!DOCTYPE " + root + " [\n")
+    file.write("<!ELEMENT " + root + " (entry*)>\n")
+    for code, description in entities:
+        file.write("<!ENTITY " + code + " \"" + description + "\">\n")
+    file.write("]>\n")
+    file.write("<" + root + ">\n")
+
+
+def generate_jmdict(file, records, rnd):
+    write_dtd_header(file, "JMdict")
+
+    for i in range(records):
+        entry = ["<entry>", "<ent_seq>%d</ent_seq>" % (1000000 + i)]
+        kebs = []
+        for j in range(rnd.randint(0, 2)):
+            kebs.append(kanji_word(rnd))
+            entry.append("<k_ele>\n<keb>" + kebs[-1] + "</keb>")
+            if rnd.random() < 0.2:
+                entry.append("<ke_inf>" + entity(rnd) + "</ke_inf>")
+            if rnd.random() < 0.3:
+                entry.append("<ke_pri>ichi1</ke_pri>")
+            entry.append("</k_ele>")
+        for j in range(rnd.randint(1, 2)):
+            entry.append("<r_ele>\n<reb>" + kana_word(rnd) + "</reb>")
+            if rnd.random() < 0.1:
+                entry.append("<re_nokanji/>")
+            if len(kebs) > 0 and rnd.random() < 0.2:
+                entry.append("<re_restr>" + kebs[0] + "</re_restr>")
+            if rnd.random() < 0.3:
+                entry.append("<re_pri>news1</re_pri>")
+            entry.append("</r_ele>")
+        for j in range(rnd.randint(1, 3)):
+            entry.append("<sense>")
+            entry.append("<pos>" + entity(rnd) + "</pos>")
+            if rnd.random() < 0.1:
+                entry.append("<xref>" + kanji_word(rnd) + "</xref>")
+            if rnd.random() < 0.1:
+                entry.append("<field>" + entity(rnd) + "</field>")
+            if rnd.random() < 0.2:
+                entry.append("<misc>" + entity(rnd) + "</misc>")
+            for k in range(rnd.randint(1, 3)):
+                entry.append("<gloss>" + rnd.choice(words) + " " + rnd.choice(words) + "</gloss>")
+            if rnd.random() < 0.3:
+                entry.append("<gloss xml:lang=\"ger\">Wort " + rnd.choice(words) + "</gloss>")
+            entry.append("</sense>")
+        entry.append("</entry>\n")
+        file.write("\n".join(entry))
+
+    file.write("</JMdict>\n")
+
+
+def generate_jmnedict(file, records, rnd):
+    write_dtd_header(file, "JMnedict")
+
+    for i in range(records):
+        entry = ["<entry>", "<ent_seq>%d</ent_seq>" % (5000000 + i)]
+        entry.append("<k_ele>\n<keb>" + kanji_word(rnd) + "</keb>\n</k_ele>")
+        entry.append("<r_ele>\n<reb>" + kana_word(rnd) + "</reb>\n</r_ele>")
+        entry.append("<trans>\n<name_type>" + entity(rnd) + "</name_type>\n<trans_det>" + rnd.choice(words).title() + "</trans_det>\n</trans>")
+        entry.append("</entry>\n")
+        file.write("\n".join(entry))
+
+    file.write("</JMnedict>\n")
+
+
+def generate_kanjidic2(file, records, rnd):
+    file.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<kanjidic2>\n<header>\n<file_version>4</file_version>\n</header>\n")
+
+    for i in range(records):
+        literal = chr(0x4e00 + i)
+        file.write("<character>\n<literal>" + literal + "</literal>\n")
+        file.write("<codepoint>\n<cp_value cp_type=\"ucs\">%x</cp_value>\n</codepoint>\n" % ord(literal))
+        file.write("<radical>\n<rad_value rad_type=\"classical\">%d</rad_value>\n</radical>\n" % rnd.randint(1, 214))
+        file.write("<misc>\n")
+        if rnd.random() < 0.5:
+            file.write("<grade>%d</grade>\n" % rnd.randint(1, 10))
+        file.write("<stroke_count>%d</stroke_count>\n" % rnd.randint(1, 25))
+        if rnd.random() < 0.5:
+            file.write("<freq>%d</freq>\n" % rnd.randint(1, 2500))
+        file.write("</misc>\n")
+        file.write("<query_code>\n<q_code qc_type=\"skip\">%d-%d-%d</q_code>\n<q_code qc_type=\"four_corner\">%04d.%d</q_code>\n</query_code>\n"
+                   % (rnd.randint(1, 4), rnd.randint(1, 20), rnd.randint(1, 20), rnd.randint(0, 9999), rnd.randint(0, 9)))
+        file.write("<reading_meaning>\n<rmgroup>\n")
+        file.write("<reading r_type=\"ja_on\">" + "".join(rnd.choice(katakana) for j in range(2)) + "</reading>\n")
+        file.write("<reading r_type=\"ja_kun\">" + kana_word(rnd) + "</reading>\n")
+        file.write("<meaning>" + rnd.choice(words) + "</meaning>\n")
+        file.write("<meaning m_lang=\"fr\">" + rnd.choice(words) + "</meaning>\n")
+        file.write("</rmgroup>\n<nanori>" + kana_word(rnd) + "</nanori>\n</reading_meaning>\n</character>\n")
+
+    file.write("</kanjidic2>\n")
+
+
+def stroke_path(rnd):
+    values = [rnd.uniform(10, 90), rnd.uniform(10, 90)] + [rnd.uniform(-20, 20) for i in range(10)]
+    return "M%.2f,%.2fc%.2f,%.2f,%.2f,%.2f,%.2f,%.2fs%.2f,%.2f,%.2f,%.2f" % tuple(values)
+
+
+def generate_kanjivg_group(file, code, depth, group_id, counter, rnd):
+    attributes = " kvg:element=\"" + rnd.choice(kanji) + "\""
+    if rnd.random() < 0.5:
+        attributes += " kvg:position=\"" + rnd.choice(["left", "right", "top", "bottom"]) + "\""
+    if rnd.random() < 0.2:
+        attributes += " kvg:radical=\"general\""
+
+    file.write("<g id=\"" + group_id + "\"" + attributes + ">\n")
+    for i in range(rnd.randint(1, 3)):
+        if depth < 3 and rnd.random() < 0.4:
+            counter[0] += 1
+            generate_kanjivg_group(file, code, depth + 1, "kvg:%s-g%d" % (code, counter[0]), counter, rnd)
+        else:
+            counter[1] += 1
+            file.write("<path id=\"kvg:%s-s%d\" kvg:type=\"㇐\" d=\"%s\"/>\n" % (code, counter[1], stroke_path(rnd)))
+    file.write("</g>\n")
+
+
+def generate_kanjivg(file, records, rnd):
+    file.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<kanjivg xmlns:kvg='http://kanjivg.tagaini.net'>\n")
+
+    for i in range(records):
+        code = "%05x" % (0x4e00 + i)
+        file.write("<kanji id=\"kvg:kanji_" + code + "\">\n")
+        generate_kanjivg_group(file, code, 0, "kvg:" + code, [0, 0], rnd)
+        file.write("</kanji>\n")
+
+    file.write("</kanjivg>\n")
+
+
+def generate_radkfile(file, records, rnd):
+    characters = kanji[:records]
+    file.write("# radkfile\n")
+
+    for stroke, radical in enumerate(radicals):
+        file.write("$ %s %d\n" % (radical, stroke % 17 + 1))
+        line = "".join(rnd.sample(characters, min(len(characters), rnd.randint(1, records // 10 + 1))))
+        while line != "":
+            file.write(line[:40] + "\n")
+            line = line[40:]
+
+
+def generate_kradfile(file, records, rnd):
+    file.write("# kradfile\n")
+
+    for character in kanji[:records]:
+        file.write(character + " : " + " ".join(rnd.sample(radicals, rnd.randint(1, 6))) + "\n")
+
+
+def generate_inputs(name, workdir, scale, seed):
+    rnd = random.Random(seed)
+    records = max(1, int(base_records[name] * scale))
+    files = [os.path.join(workdir, file) for option, file in converters[name][1]]
+
+    # Kanji based inputs can not have more records than available characters
+    if name in ("radkfile", "kradfile"):
+        records = min(records, len(kanji))
+    elif name in ("kanjidic2", "kanjivg"):
+        records = min(records, 0x9fff - 0x4e00)
+
+    if name == "jmdict":
+        with codecs.open(files[0], "w", "utf8") as file:
+            generate_jmdict(file, records, rnd)
+    elif name == "jmnedict":
+        with codecs.open(files[0], "w", "utf8") as file:
+            generate_jmnedict(file, records, rnd)
+    elif name == "kanjidic2":
+        with codecs.open(files[0], "w", "utf8") as file:
+            generate_kanjidic2(file, records, rnd)
+    elif name == "kanjivg":
+        with codecs.open(files[0], "w", "utf8") as file:
+            generate_kanjivg(file, records, rnd)
+    else:
+        # Converters read two files, the second one is generated smaller
+        for index, path in enumerate(files):
+            with codecs.open(path, "w", "euc-jp") as file:
+                if name == "radkfile":
+                    generate_radkfile(file, records // (index + 1), rnd)
+                else:
+                    generate_kradfile(file, records // (index + 1), rnd)
+        if name == "radkfile":
+            records = len(radicals) * len(files)
+        else:
+            records = records + records // 2
+
+    return files, records
+
+
+class NullCursor:
+    # Statements are ignored, every statement gets a new rowid and queries
+    # return no rows (or 0 for the max rowid read by the row writer)
+    def __init__(self, database):
+        self.database = database
+        self.lastrowid = None
+
+    def execute(self, sql, parameters=()):
+        self.database.last_rowid += 1
+        self.lastrowid = self.database.last_rowid
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        return self
+
+    def fetchone(self):
+        return (0,)
+
+    def fetchall(self):
+        return []
+
+
+class NullDatabase:
+    # Used in place of the sqlite connection by --parseonly, nothing is
+    # written so only the parsing and the building of the rows are measured
+    def __init__(self):
+        self.last_rowid = 0
+
+    def cursor(self):
+        return NullCursor(self)
+
+    def executemany(self, sql, seq_of_parameters):
+        pass
+
+    def commit(self):
+        pass
+
+
+class TableNames(dict):
+    # Table names of the converters without creating any database, they
+    # are only used into the ignored statements
+    def __missing__(self, name):
+        return name
+
+
+def parse_input(name, path):
+    script = converters[name][0]
+    database = NullDatabase()
+
+    # The parse functions of the converter are the same run by a normal
+    # import, only the database is replaced
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", script))
+    converter = importlib.import_module(script)
+    converter.dbtable = TableNames()
+
+    if name == "jmdict":
+        converter.parse_jmdict(path, database, parse_batch_size)
+    elif name == "jmnedict":
+        converter.parse_jmnedict(path, database)
+    elif name == "kanjidic2":
+        converter.parse_kanjidic2(path, database, parse_batch_size)
+    elif name == "kanjivg":
+        converter.parse_kanjisv(path, database, parse_batch_size)
+    else:
+        input_file = converter.open_input(path)
+        converter.import_data_file(database, input_file)
+        input_file.close()
+
+    return converter.metrics.entries
+
+
+def run_child(command):
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    peak_rss = None
+
+    # wait4 returns the resources used by that child only, it is not
+    # available on Windows where the peak memory is not reported
+    if hasattr(os, "wait4"):
+        pid, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        peak_rss = usage.ru_maxrss * 1024
+        if sys.platform == "darwin":
+            peak_rss = usage.ru_maxrss
+    else:
+        process.wait()
+
+    return process.returncode, time.perf_counter() - start, peak_rss
+
+
+def run_benchmark(name, files, workdir, parseonly, fastbuild):
+    if parseonly:
+        # Every input file is parsed by its own child process
+        results = [run_child([sys.executable, os.path.abspath(__file__), "--parse", name, path]) for path in files]
+        returncode = max(result[0] for result in results)
+        seconds = sum(result[1] for result in results)
+        peak_rss = None if results[0][2] == None else max(result[2] for result in results)
+        return returncode, seconds, peak_rss, None
+
+    script = converters[name][0]
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", script, script + ".py")]
+    sqlitefile = os.path.join(workdir, name + ".db")
+
+    for (option, file), path in zip(converters[name][1], files):
+        command += [option, path]
+    command += ["--sqlitefile", sqlitefile]
+    if fastbuild:
+        command.append("--fastbuild")
+
+    if os.path.exists(sqlitefile):
+        os.remove(sqlitefile)
+
+    returncode, seconds, peak_rss = run_child(command)
+    db_size = os.path.getsize(sqlitefile) if os.path.exists(sqlitefile) else None
+
+    return returncode, seconds, peak_rss, db_size
+
+
+def format_size(size):
+    if size == None:
+        return "n/a"
+    return "%.1f" % (size / (1024 * 1024))
+
+
+def main():
+    args = parse_cmdline()
+
+    if args.parse != None:
+        parse_input(args.parse[0], args.parse[1])
+        return
+
+    names = [name.strip() for name in args.converters.split(",") if name.strip() != ""]
+    for name in names:
+        if name not in converters:
+            print("Unknown converter " + name)
+            return
+
+    init_characters()
+    os.makedirs(args.workdir, exist_ok=True)
+
+    print("%-10s %10s %10s %12s %14s %12s" % ("converter", "records", "seconds", "records/s", "peak RSS MB", "db size MB"))
+
+    for name in names:
+        files, records = generate_inputs(name, args.workdir, args.scale, args.seed)
+        returncode, seconds, peak_rss, db_size = run_benchmark(name, files, args.workdir, args.parseonly, args.fastbuild)
+
+        if returncode != 0:
+            print("%-10s failed with exit code %d" % (name, returncode))
+            continue
+
+        print("%-10s %10d %10.2f %12.0f %14s %12s" % (name, records, seconds, records / seconds, format_size(peak_rss), format_size(db_size)))
+
+
+if __name__ == '__main__':
+    main()
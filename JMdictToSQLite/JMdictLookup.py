@@ -0,0 +1,168 @@
+
+from collections import OrderedDict
+import sqlite3
+import sys
+import os
+import json
+import zlib
+
+# Entries are read back and prefix searches normalized like the importer,
+# see SQLiteImport.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "SQLiteImport"))
+from SQLiteImport import read_entries, normalize_reading
+
+# Example use:
+#   lookup = JMdictLookup("jmdict.db")
+#   entry = lookup.get_entry(1)
+#   entries = lookup.find_entries(["明白", "めいはく"])
+#
+# Entries are returned as dict, for example:
+#   {"id": 1, "ent_seq": 1000000,
+#    "k_ele": [{"keb": "明白", "ke_inf": [], "ke_pri": ["ichi1"]}],
+#    "r_ele": [{"reb": "めいはく", "re_nokanji": "", "re_restr": [], "re_inf": [], "re_pri": ["ichi1"]}],
+#    "sense": [{"pos": ["adj-na"], "gloss": ["obvious"], ...}]}
+#
+# Entity values (pos, misc, field, ...) are returned as their DTD code. Only
+# the elements imported into the database are present. If the database was
+# built with --entryblobs each entry is read from its single blob row.
+# Returned entries are shared with the cache, so they must not be modified.
+# Like any sqlite connection, an instance must be used by a single thread.
+
+entry_elements = {
+    "k_ele": ["ke_inf", "ke_pri"],
+    "r_ele": ["re_restr", "re_inf", "re_pri"],
+    "sense": ["stagk", "stagr", "pos", "xref", "ant", "field", "misc", "s_inf", "dial", "gloss"]
+    }
+
+entity_elements = ["ke_inf", "re_inf", "pos", "field", "misc", "dial"]
+
+entry_columns = {"k_ele": ["keb"], "r_ele": ["reb", "re_nokanji"]}
+
+class JMdictLookup:
+    def __init__(self, sqlitefile, prefix="jmdict", cache_size=1024):
+        if(prefix != ""):
+            prefix += "_"
+
+        self.prefix = prefix
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.database = sqlite3.connect(sqlitefile, isolation_level=None)
+
+        c = self.database.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        self.tables = set(row[0] for row in c.fetchall())
+        self.blobs = self.table("entry_blob") in self.tables
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_id (id INTEGER PRIMARY KEY)")
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_word (word TEXT)")
+
+        # Names of the tables read for the entries, only the ones present
+        names = ["entry", "entity"] + [element + "_" + child for element, children in entry_elements.items() for child in children] + list(entry_elements)
+        self.entry_tables = dict((name, self.table(name)) for name in names if self.table(name) in self.tables)
+
+    def close(self):
+        self.database.close()
+
+    def table(self, name):
+        return self.prefix + name
+
+    def get_entry(self, entry_id):
+        return self.get_entries([entry_id])[0]
+
+    def get_entry_seq(self, ent_seq):
+        c = self.database.cursor()
+
+        if self.blobs:
+            c.execute("SELECT entry_id FROM " + self.table("entry_blob") + " WHERE ent_seq = ?", [ent_seq])
+        else:
+            c.execute("SELECT rowid FROM " + self.table("entry") + " WHERE ent_seq = ?", [ent_seq])
+        row = c.fetchone()
+        if row == None:
+            return None
+
+        return self.get_entry(row[0])
+
+    def get_entries(self, entry_ids):
+        entries = dict()
+        missing = []
+
+        for entry_id in entry_ids:
+            if entry_id in self.cache:
+                self.cache.move_to_end(entry_id)
+                entries[entry_id] = self.cache[entry_id]
+            else:
+                missing.append(entry_id)
+
+        if len(missing) > 0:
+            entries.update(self.read_entries(missing))
+            for entry_id in missing:
+                if entry_id in entries:
+                    self.cache[entry_id] = entries[entry_id]
+                    # Least recently used entries are evicted first
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+
+        return [entries.get(entry_id) for entry_id in entry_ids]
+
+    def read_entries(self, entry_ids):
+        if not self.blobs:
+            return read_entries(self.database, self.entry_tables, entry_elements, entry_columns, entity_elements, "lookup_id", entry_ids)
+
+        c = self.database.cursor()
+        entries = dict()
+
+        c.execute("DELETE FROM temp.lookup_id")
+        c.executemany("INSERT OR IGNORE INTO temp.lookup_id (id) VALUES (?)", [(entry_id,) for entry_id in entry_ids])
+
+        c.execute("SELECT entry_id, data FROM " + self.table("entry_blob") + " WHERE entry_id IN (SELECT id FROM temp.lookup_id)")
+        for entry_id, data in c.fetchall():
+            entries[entry_id] = json.loads(zlib.decompress(data))
+
+        return entries
+
+    def find_entries(self, words):
+        c = self.database.cursor()
+        found = dict((word, []) for word in words)
+
+        # All the words are matched against keb and reb with a single join
+        c.execute("DELETE FROM temp.lookup_word")
+        c.executemany("INSERT INTO temp.lookup_word (word) VALUES (?)", [(word,) for word in found])
+
+        queries = []
+        if self.table("k_ele") in self.tables:
+            queries.append("SELECT word.word, k_ele.entry_id FROM temp.lookup_word word JOIN " + self.table("k_ele") + " k_ele ON k_ele.keb = word.word")
+        if self.table("r_ele") in self.tables:
+            queries.append("SELECT word.word, r_ele.entry_id FROM temp.lookup_word word JOIN " + self.table("r_ele") + " r_ele ON r_ele.reb = word.word")
+        if len(queries) == 0:
+            return found
+
+        c.execute(" UNION ".join(queries) + " ORDER BY 2")
+        rows = c.fetchall()
+        entries = self.get_entries(list(OrderedDict.fromkeys(entry_id for word, entry_id in rows)))
+        entries = dict((entry["id"], entry) for entry in entries)
+
+        for word, entry_id in rows:
+            found[word].append(entries[entry_id])
+
+        return found
+
+    def find_prefix(self, text, limit=20):
+        c = self.database.cursor()
+        prefix = normalize_reading(text)
+        matches = []
+
+        if prefix == "":
+            return []
+
+        # Every string starting with prefix is between prefix and the
+        # prefix having the last character incremented by one
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+        for element, column in (("r_ele", "reb_norm"), ("k_ele", "keb_norm")):
+            if self.table(element) in self.tables:
+                c.execute("SELECT " + column + ", entry_id FROM " + self.table(element) + " WHERE " + column + " >= ? AND " + column + " < ? ORDER BY " + column + " LIMIT ?", (prefix, end, limit))
+                matches.extend(c.fetchall())
+
+        matches.sort()
+        entry_ids = list(OrderedDict.fromkeys(entry_id for norm, entry_id in matches))[:limit]
+
+        return self.get_entries(entry_ids)
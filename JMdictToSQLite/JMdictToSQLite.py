@@ -1,10 +1,19 @@
 
 from argparse import ArgumentParser, FileType, Action
+from collections import deque
 import xml.etree.ElementTree as ET
 import sqlite3
 import sys
 import os
-import codecs
+import shutil
+import hashlib
+import multiprocessing
+import json
+import zlib
+
+# Helpers shared by all the converters, see SQLiteImport.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "SQLiteImport"))
+from SQLiteImport import metrics, sqltrace, fast_build_pragmas, RowBuffer, RowWriter, store_entities, read_entries, normalize_reading, open_input, input_position, read_xml_prolog
 
 # Comment xml elements you don't want to be imported into database (please
 # note, if you comment main elements like, for example, "k_ele", "r_ele" or 
@@ -33,25 +42,95 @@ xml_elements = [
     "gloss"
     ]
 
+# Lookups done by a typical dictionary client, with --tracesql the query
+# plan of each one is checked for full table scans
+audit_queries = [
+    "SELECT rowid FROM {entry} WHERE ent_seq = ?",
+    "SELECT entry_id FROM {k_ele} WHERE keb = ?",
+    "SELECT entry_id FROM {r_ele} WHERE reb = ?",
+    "SELECT entry_id FROM {k_ele} WHERE keb_norm >= ? AND keb_norm < ?",
+    "SELECT entry_id FROM {r_ele} WHERE reb_norm >= ? AND reb_norm < ?",
+    "SELECT rowid, keb FROM {k_ele} WHERE entry_id = ?",
+    "SELECT rowid, reb FROM {r_ele} WHERE entry_id = ?",
+    "SELECT rowid FROM {sense} WHERE entry_id = ?",
+    "SELECT ke_pri FROM {k_ele_ke_pri} WHERE k_ele_id = ?",
+    "SELECT re_pri FROM {r_ele_re_pri} WHERE r_ele_id = ?",
+    "SELECT gloss FROM {sense_gloss} WHERE sense_id = ?",
+    "SELECT sense_id FROM {sense_pos} WHERE pos_id = (SELECT rowid FROM {entity} WHERE code = ?)",
+    "SELECT sense_id FROM {sense_misc} WHERE misc_id = (SELECT rowid FROM {entity} WHERE code = ?)",
+    "SELECT data FROM {entry_blob} WHERE entry_id = ?",
+    "SELECT data FROM {entry_blob} WHERE ent_seq = ?"
+    ]
+
+# Child tables of every entry element stored into the entry blobs, values
+# of the entity children are stored as their DTD code
+entry_elements = {
+    "k_ele": ["ke_inf", "ke_pri"],
+    "r_ele": ["re_restr", "re_inf", "re_pri"],
+    "sense": ["stagk", "stagr", "pos", "xref", "ant", "field", "misc", "s_inf", "dial", "gloss"]
+    }
+
+entity_elements = ["ke_inf", "re_inf", "pos", "field", "misc", "dial"]
+
+# Value columns of the element tables stored into the entry blobs
+entry_columns = {"k_ele": ["keb"], "r_ele": ["reb", "re_nokanji"]}
+
+# Table and entity flag of every imported child of k_ele, r_ele and sense,
+# the parser looks up each child tag once instead of comparing it with all
+# the element names
+child_tables = dict((child, (element + "_" + child, child in entity_elements))
+                    for element, children in entry_elements.items() for child in children
+                    if element in xml_elements and child in xml_elements)
+
+# Number of entries parsed together from the raw xml (and sent to a worker
+# process with --jobs)
+entries_per_batch = 1000
+
+# Number of entries read back from the tables for each batch of blobs
+blob_batch_size = 1000
+
+# Languages of the glosses to import (ISO 639-2 codes as in the xml:lang
+# attribute, "eng" if missing), empty to import all of them
+gloss_languages = set()
+xml_lang = "{http://www.w3.org/XML/1998/namespace}lang"
+
+# Tables having child tables, their rowid is assigned while parsing so
+# the child rows can be built before the parent row is inserted
+id_tables = ("entry", "k_ele", "r_ele", "sense")
+
 dbtable = dict()
+dbindex = list()
+dbfile = dict()
 
 def parse_cmdline():
     parser = ArgumentParser()
-    parser.add_argument("--jmdictfile", help="path to the .xml JMdict file", default="JMdict_e")
+    parser.add_argument("--jmdictfile", help="path to the .xml JMdict file (gzip, xz or bzip2 compressed files are accepted)", default="JMdict_e")
     parser.add_argument("--sqlitefile", help="path to the sqlite database to create", required=True)
     parser.add_argument("--dbtableprefix", help="prefix of db tables (ex. jmdict)", default="jmdict")
     parser.add_argument("--appendtables", help="append tables into an existing database file", action="store_true")
-    return parser.parse_args()
-
-
-def create_database(name, prefix, append):
-    sqlitefile = name
+    parser.add_argument("--fastbuild", "--fast-build", help="build the database into a temporary file with bulk load settings", action="store_true")
+    parser.add_argument("--update", help="update an existing database with only the entries changed since the last import", action="store_true")
+    parser.add_argument("--fts", help="build a FTS5 full text index over the glosses", action="store_true")
+    parser.add_argument("--entryblobs", "--entry-blobs", help="also store every entry as a single compressed json row, to read a full entry with one query", action="store_true")
+    parser.add_argument("--languages", help="comma separated list of the gloss languages to import (ex. eng,ger), default all")
+    parser.add_argument("--jobs", help="number of worker processes used to parse the entries (ignored with a single CPU), the import takes at most about 40%% less time", type=int, default=1)
+    parser.add_argument("--batchsize", help="number of rows written to each table with a single statement", type=int, default=10000)
+    parser.add_argument("--metricsfile", help="write the import metrics (phase times, rows per table, peak memory) to this json file")
+    parser.add_argument("--tracesql", "--trace-sql", help="report the time spent by every sql statement and check the query plans of the common lookups", action="store_true")
+    args = parser.parse_args()
+    if args.update and (args.appendtables or args.fastbuild or args.jobs > 1):
+        parser.error("--update can not be used with --appendtables, --fastbuild or --jobs")
+    return args
+
+
+def set_table_names(prefix):
     global dbtable
 
     if(prefix != ""):
         prefix += "_"
 
     dbtable["entry"] = prefix + "entry"
+    dbtable["entity"] = prefix + "entity"
     dbtable["k_ele"] = prefix + "k_ele"
     dbtable["k_ele_ke_inf"] = prefix + "k_ele_ke_inf"
     dbtable["k_ele_ke_pri"] = prefix + "k_ele_ke_pri"
@@ -70,251 +149,739 @@ def create_database(name, prefix, append):
     dbtable["sense_s_inf"] = prefix + "sense_s_inf"
     dbtable["sense_dial"] = prefix + "sense_dial"
     dbtable["sense_gloss"] = prefix + "sense_gloss"
+    dbtable["gloss_fts"] = prefix + "gloss_fts"
+    dbtable["entry_blob"] = prefix + "entry_blob"
+
+
+def create_database(name, prefix, append, fastbuild):
+    sqlitefile = name
+    set_table_names(prefix)
 
     if len(sqlitefile) < 3 or sqlitefile[-3:] != ".db":
         sqlitefile = sqlitefile + ".db"
 
-    if append == False and os.path.exists(sqlitefile):
+    dbfile["name"] = sqlitefile
+    dbfile["fastbuild"] = fastbuild
+
+    if fastbuild:
+        # Database is built into a temporary file renamed only at the end
+        sqlitefile = sqlitefile + ".tmp"
+        if os.path.exists(sqlitefile):
+            os.remove(sqlitefile)
+        if append == True and os.path.exists(dbfile["name"]):
+            shutil.copyfile(dbfile["name"], sqlitefile)
+    elif append == False and os.path.exists(sqlitefile):
         os.remove(sqlitefile)
 
-    database = sqlite3.connect(sqlitefile)
+    dbfile["build"] = sqlitefile
+    database = sqltrace.connect(sqlitefile)
     c = database.cursor()
 
-    c.execute("CREATE TABLE " + dbtable["entry"] + " (ent_seq INTEGER DEFAULT 0)")
+    if fastbuild:
+        for pragma in fast_build_pragmas:
+            c.execute(pragma)
+
+    table_name = dbtable["entry"]
+    c.execute("CREATE TABLE " + table_name + " (ent_seq INTEGER DEFAULT 0, hash TEXT DEFAULT '')")
+    dbindex.append("CREATE INDEX " + table_name + "_ent_seq_index ON " + table_name + " (ent_seq)")
+
+    table_name = dbtable["entity"]
+    c.execute("CREATE TABLE " + table_name + " (code TEXT, description TEXT)")
+    dbindex.append("CREATE INDEX " + table_name + "_code_index ON " + table_name + " (code)")
 
     if "k_ele" in xml_elements:
         table_name = dbtable["k_ele"]
-        c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER, keb TEXT DEFAULT '')")
-        c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
-        c.execute("CREATE INDEX " + table_name + "_keb_index ON " + table_name + " (keb)")
+        c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER, keb TEXT DEFAULT '', keb_norm TEXT DEFAULT '')")
+        dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
+        dbindex.append("CREATE INDEX " + table_name + "_keb_index ON " + table_name + " (keb)")
+        dbindex.append("CREATE INDEX " + table_name + "_keb_norm_index ON " + table_name + " (keb_norm, entry_id)")
 
         if "ke_inf" in xml_elements:
             table_name = dbtable["k_ele_ke_inf"]
-            c.execute("CREATE TABLE " + table_name + " (k_ele_id INTEGER, ke_inf TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (k_ele_id)")
+            c.execute("CREATE TABLE " + table_name + " (k_ele_id INTEGER, ke_inf_id INTEGER)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (k_ele_id)")
 
         if "ke_pri" in xml_elements:
             table_name = dbtable["k_ele_ke_pri"]
             c.execute("CREATE TABLE " + table_name + " (k_ele_id INTEGER, ke_pri TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (k_ele_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (k_ele_id)")
 
     if "r_ele" in xml_elements:
         table_name = dbtable["r_ele"]
-        c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER, reb TEXT DEFAULT '', re_nokanji TEXT DEFAULT '')")
-        c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
-        c.execute("CREATE INDEX " + table_name + "_reb_index ON " + table_name + " (reb)")
+        c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER, reb TEXT DEFAULT '', re_nokanji TEXT DEFAULT '', reb_norm TEXT DEFAULT '')")
+        dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
+        dbindex.append("CREATE INDEX " + table_name + "_reb_index ON " + table_name + " (reb)")
+        # The normalized columns are indexed together with entry_id for as you type
+        # prefix searches using a range scan, for example (prefix 'かん'):
+        # select distinct entry_id from jmdict_r_ele where reb_norm >= 'かん' and reb_norm < 'かゔ'
+        dbindex.append("CREATE INDEX " + table_name + "_reb_norm_index ON " + table_name + " (reb_norm, entry_id)")
 
         if "re_restr" in xml_elements:
             table_name = dbtable["r_ele_re_restr"]
             c.execute("CREATE TABLE " + table_name + " (r_ele_id INTEGER, re_restr TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
 
         if "re_inf" in xml_elements:
             table_name = dbtable["r_ele_re_inf"]
-            c.execute("CREATE TABLE " + table_name + " (r_ele_id INTEGER, re_inf TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
+            c.execute("CREATE TABLE " + table_name + " (r_ele_id INTEGER, re_inf_id INTEGER)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
 
         if "re_pri" in xml_elements:
             table_name = dbtable["r_ele_re_pri"]
             c.execute("CREATE TABLE " + table_name + " (r_ele_id INTEGER, re_pri TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
 
     if "sense" in xml_elements:
         table_name = dbtable["sense"]
         c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER)")
-        c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
+        dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
 
         if "stagk" in xml_elements:
             table_name = dbtable["sense_stagk"]
             c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, stagk TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
 
         if "stagr" in xml_elements:
             table_name = dbtable["sense_stagr"]
             c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, stagr TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
 
         if "pos" in xml_elements:
             table_name = dbtable["sense_pos"]
-            c.execute("CREATE TABLE " + dbtable["sense_pos"] + " (sense_id INTEGER, pos TEXT)")
-            c.execute("CREATE INDEX " + dbtable["sense_pos"] + "_id_index ON " + dbtable["sense_pos"] + " (sense_id)")
+            c.execute("CREATE TABLE " + dbtable["sense_pos"] + " (sense_id INTEGER, pos_id INTEGER)")
+            dbindex.append("CREATE INDEX " + dbtable["sense_pos"] + "_id_index ON " + dbtable["sense_pos"] + " (sense_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_pos_index ON " + table_name + " (pos_id, sense_id)")
 
         if "xref" in xml_elements:
             table_name = dbtable["sense_xref"]
             c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, xref TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
 
         if "ant" in xml_elements:
             table_name = dbtable["sense_ant"]
             c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, ant TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
 
         if "field" in xml_elements:
             table_name = dbtable["sense_field"]
-            c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, field TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, field_id INTEGER)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_field_index ON " + table_name + " (field_id, sense_id)")
 
         if "misc" in xml_elements:
             table_name = dbtable["sense_misc"]
-            c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, misc TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, misc_id INTEGER)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_misc_index ON " + table_name + " (misc_id, sense_id)")
 
         if "s_inf" in xml_elements:
             table_name = dbtable["sense_s_inf"]
             c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, s_inf TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
 
         if "dial" in xml_elements:
             table_name = dbtable["sense_dial"]
-            c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, dial TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, dial_id INTEGER)")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            dbindex.append("CREATE INDEX " + table_name + "_dial_index ON " + table_name + " (dial_id, sense_id)")
 
         if "gloss" in xml_elements:
             table_name = dbtable["sense_gloss"]
-            c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, gloss TEXT)")
-            c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
+            c.execute("CREATE TABLE " + table_name + " (sense_id INTEGER, gloss TEXT, lang TEXT DEFAULT 'eng')")
+            dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (sense_id)")
 
     return database
 
 
-def parse_k_ele(k_ele, entry_id, dtd, database):
+def open_database(name, prefix):
+    sqlitefile = name
+    set_table_names(prefix)
+
+    if len(sqlitefile) < 3 or sqlitefile[-3:] != ".db":
+        sqlitefile = sqlitefile + ".db"
+
+    if not os.path.exists(sqlitefile):
+        return None
+
+    dbfile["name"] = sqlitefile
+    dbfile["build"] = sqlitefile
+    dbfile["fastbuild"] = False
+
+    return sqltrace.connect(sqlitefile)
+
+
+def create_indexes(database):
     c = database.cursor()
-    c.execute("INSERT INTO " + dbtable["k_ele"] + " (entry_id) VALUES (?)", [entry_id])
-    k_ele_id = c.lastrowid
+
+    with metrics.phase("index"):
+        for query in dbindex:
+            c.execute(query)
+
+    dbindex.clear()
+
+
+def close_database(database):
+    # Tables are always created empty, so they are filled without indexes
+    # and all of them are created in a single pass once the data has been
+    # imported (nothing is left to create after an update)
+    create_indexes(database)
+
+    with metrics.phase("commit"):
+        database.commit()
+    database.close()
+
+    if dbfile["fastbuild"]:
+        os.replace(dbfile["build"], dbfile["name"])
+
+
+def parse_k_ele(k_ele, entry_id, dtd, writer):
+    k_ele_id = writer.new_id("k_ele")
+    rows = writer.rows
+    keb = ""
 
     for item in k_ele:
-        if item.tag not in xml_elements:
-            continue
         if item.tag == "keb":
-            c.execute("UPDATE " + dbtable["k_ele"] + " SET keb = ? WHERE rowid = ?", (item.text, k_ele_id))
-        elif item.tag == "ke_inf":
-            c.execute("INSERT INTO " + dbtable["k_ele_ke_inf"] + " (k_ele_id, ke_inf) VALUES (?, ?)", (k_ele_id, dtd[item.text]))
-        elif item.tag == "ke_pri":
-            c.execute("INSERT INTO " + dbtable["k_ele_ke_pri"] + " (k_ele_id, ke_pri) VALUES (?, ?)", (k_ele_id, item.text))
+            if "keb" in xml_elements:
+                keb = item.text
+            continue
+        child = child_tables.get(item.tag)
+        if child == None:
+            continue
+        table, entity = child
+        rows[table].append((k_ele_id, dtd[item.text] if entity else item.text))
 
+    rows["k_ele"].append((k_ele_id, entry_id, keb, normalize_reading(keb)))
 
-def parse_r_ele(r_ele, entry_id, dtd, database):
-    c = database.cursor()
-    c.execute("INSERT INTO " + dbtable["r_ele"] + " (entry_id) VALUES (?)", [entry_id])
-    r_ele_id = c.lastrowid
+
+def parse_r_ele(r_ele, entry_id, dtd, writer):
+    r_ele_id = writer.new_id("r_ele")
+    rows = writer.rows
+    reb = ""
+    re_nokanji = ""
 
     for item in r_ele:
-        if item.tag not in xml_elements:
-            continue
         if item.tag == "reb":
-            c.execute("UPDATE " + dbtable["r_ele"] + " SET reb = ? WHERE rowid = ?", (item.text, r_ele_id))
-        elif item.tag == "re_nokanji":
-            if(item.text != None):
-                c.execute("UPDATE " + dbtable["r_ele"] + " SET re_nokanji = ? WHERE rowid = ?", (item.text, r_ele_id))
-        elif item.tag == "re_restr":
-            c.execute("INSERT INTO " + dbtable["r_ele_re_restr"] + " (r_ele_id, re_restr) VALUES (?, ?)", (r_ele_id, item.text))
-        elif item.tag == "re_inf":
-            c.execute("INSERT INTO " + dbtable["r_ele_re_inf"] + " (r_ele_id, re_inf) VALUES (?, ?)", (r_ele_id, dtd[item.text]))
-        elif item.tag == "re_pri":
-            c.execute("INSERT INTO " + dbtable["r_ele_re_pri"] + " (r_ele_id, re_pri) VALUES (?, ?)", (r_ele_id, item.text))
-
-
-def parse_sense(sense, entry_id, dtd, database):
-    c = database.cursor()
-    c.execute("INSERT INTO " + dbtable["sense"] + " (entry_id) VALUES (?)", [entry_id])
-    sense_id = c.lastrowid
+            if "reb" in xml_elements:
+                reb = item.text
+            continue
+        if item.tag == "re_nokanji":
+            if "re_nokanji" in xml_elements and item.text != None:
+                re_nokanji = item.text
+            continue
+        child = child_tables.get(item.tag)
+        if child == None:
+            continue
+        table, entity = child
+        rows[table].append((r_ele_id, dtd[item.text] if entity else item.text))
+
+    rows["r_ele"].append((r_ele_id, entry_id, reb, re_nokanji, normalize_reading(reb)))
+
+
+def parse_sense(sense, entry_id, dtd, writer):
+    sense_id = writer.new_id("sense")
+    rows = writer.rows
+
+    # In the multilingual file the glosses of each language have their own
+    # sense elements, senses having only glosses of other languages are
+    # skipped entirely. The id is used anyway since the parallel import
+    # reserves one for every sense element
+    if len(gloss_languages) > 0 and "gloss" in xml_elements:
+        languages = set(item.get(xml_lang, "eng") for item in sense if item.tag == "gloss")
+        if len(languages) > 0 and languages.isdisjoint(gloss_languages):
+            return
+
+    rows["sense"].append((sense_id, entry_id))
 
+    # Rows are added straight to the writer buffers, the tables are written
+    # when the whole entry has been parsed
     for item in sense:
-        if item.tag not in xml_elements:
+        child = child_tables.get(item.tag)
+        if child == None:
             continue
-        if item.tag == "stagk":
-            c.execute("INSERT INTO " + dbtable["sense_stagk"] + " (sense_id, stagk) VALUES (?, ?)", (sense_id, item.text))
-        elif item.tag == "stagr":
-            c.execute("INSERT INTO " + dbtable["sense_stagr"] + " (sense_id, stagr) VALUES (?, ?)", (sense_id, item.text))
-        elif item.tag == "pos":
-            c.execute("INSERT INTO " + dbtable["sense_pos"] + " (sense_id, pos) VALUES (?, ?)", (sense_id, dtd[item.text]))
-        elif item.tag == "xref":
-            c.execute("INSERT INTO " + dbtable["sense_xref"] + " (sense_id, xref) VALUES (?, ?)", (sense_id, item.text))
-        elif item.tag == "ant":
-            c.execute("INSERT INTO " + dbtable["sense_ant"] + " (sense_id, ant) VALUES (?, ?)", (sense_id, item.text))
-        elif item.tag == "field":
-            c.execute("INSERT INTO " + dbtable["sense_field"] + " (sense_id, field) VALUES (?, ?)", (sense_id, dtd[item.text]))
-        elif item.tag == "misc":
-            c.execute("INSERT INTO " + dbtable["sense_misc"] + " (sense_id, misc) VALUES (?, ?)", (sense_id, dtd[item.text]))
-        elif item.tag == "s_inf":
-            c.execute("INSERT INTO " + dbtable["sense_s_inf"] + " (sense_id, s_inf) VALUES (?, ?)", (sense_id, item.text))
-        elif item.tag == "dial":
-            c.execute("INSERT INTO " + dbtable["sense_dial"] + " (sense_id, dial) VALUES (?, ?)", (sense_id, dtd[item.text]))
-        elif item.tag == "gloss":
-            c.execute("INSERT INTO " + dbtable["sense_gloss"] + " (sense_id, gloss) VALUES (?, ?)", (sense_id, item.text))
-
-
-def parse_entry(entry, dtd, database):
-    c = database.cursor()
-    c.execute("INSERT INTO " + dbtable["entry"] + " DEFAULT VALUES")
-    entry_id = c.lastrowid
+        table, entity = child
+        if item.tag == "gloss":
+            lang = item.get(xml_lang, "eng")
+            if len(gloss_languages) == 0 or lang in gloss_languages:
+                rows[table].append((sense_id, item.text, lang))
+        elif entity:
+            rows[table].append((sense_id, dtd[item.text]))
+        else:
+            rows[table].append((sense_id, item.text))
+
+
+def entry_hash(data):
+    digest = hashlib.sha1()
+
+    # Hash of the raw entry bytes used by --update to find changed entries.
+    # The gloss languages are part of the hash, so an update with a
+    # different --languages replaces all the entries
+    if len(gloss_languages) > 0:
+        digest.update(",".join(sorted(gloss_languages)).encode("utf8") + b"\0")
+    digest.update(data)
+
+    return digest.hexdigest()
+
+
+def parse_entry(entry, data, dtd, writer, entry_id=None):
+    if entry_id == None:
+        entry_id = writer.new_id("entry")
+    ent_seq = 0
     
     for item in entry:
-        if item.tag not in xml_elements:
-            continue
         if item.tag == "ent_seq":
-            c.execute("UPDATE " + dbtable["entry"] + " SET ent_seq = ? WHERE rowid = ?", (item.text, entry_id))
+            ent_seq = item.text
+        elif item.tag not in xml_elements:
+            continue
         elif item.tag == "k_ele":
-            parse_k_ele(item, entry_id, dtd, database)
+            parse_k_ele(item, entry_id, dtd, writer)
         elif item.tag == "r_ele":
-            parse_r_ele(item, entry_id, dtd, database)
+            parse_r_ele(item, entry_id, dtd, writer)
         elif item.tag == "sense":
-            parse_sense(item, entry_id, dtd, database)
-
-
-def load_xml_dtd(file):
-    xml_file = codecs.open(file, "r", "utf8")
-    value_list = []
-    code_list = []
-
-    # Currently the only way I found for extract the xml DTD list
-    # is to manually get entity lines and make a small parsing
-    for line in xml_file:
-        if len(line) >= 2 and line[0:2] == "]>":
-            break
-        if len(line) >= 15 and line[0:8] == "<!ENTITY":
-            code_list.append(line.split(" ")[1])
-            value_list.append(line.split("\"")[1])
-            
-    xml_file.close()
+            parse_sense(item, entry_id, dtd, writer)
+
+    writer.rows["entry"].append((entry_id, ent_seq, entry_hash(data)))
 
-    return dict(zip(value_list, code_list))
+    return entry_id
+
+
+def iter_raw_entries(xml_file, data):
+    pos = 0
+
+    # Entries are located by their tags in the raw byte stream, in this way
+    # each one is available as it is in the file for the hash and, with
+    # --jobs, the main process leaves all the parsing work to the workers
+    while True:
+        start = data.find(b"<entry>", pos)
+        end = data.find(b"</entry>", start) if start != -1 else -1
+        if end == -1:
+            chunk = xml_file.read(1048576)
+            if not chunk:
+                return
+            data = data[pos:] + chunk
+            pos = 0
+            continue
+        pos = end + len(b"</entry>")
+        yield data[start:pos]
 
 
-def parse_jmdict(file, database):
-    dtd = load_xml_dtd(file)
-    tree = ET.parse(file)
-    root = tree.getroot()
+def iter_entries(xml_file, prolog, data):
+    batch = []
+
+    # Entries are parsed in batches of raw entries completed by the prolog,
+    # as done by the workers of the parallel import. Every entry element is
+    # returned together with its raw bytes
+    for entry in iter_raw_entries(xml_file, data):
+        batch.append(entry)
+        if len(batch) == entries_per_batch:
+            yield from zip(batch, ET.fromstring(prolog + b"".join(batch) + b"</JMdict>"))
+            batch = []
+
+    if len(batch) > 0:
+        yield from zip(batch, ET.fromstring(prolog + b"".join(batch) + b"</JMdict>"))
+
+
+def parse_jmdict(file, database, batch_size):
+    writer = RowWriter(database, dbtable, id_tables, batch_size)
+    xml_file = open_input(file)
+    entities, prolog, data = read_xml_prolog(xml_file, "JMdict")
     counter = 0
 
-    if root.tag != "JMdict":
+    if prolog == None:
         print("Invalid JMdict file")
+        xml_file.close()
         return
 
-    for item in root:
-        if item.tag == "entry":
-            parse_entry(item, dtd, database)
+    with metrics.phase("dtd"):
+        dtd = store_entities(database, dbtable["entity"], entities)
+
+    metrics.set_input(xml_file)
+    with metrics.phase("parse"):
+        for data, item in iter_entries(xml_file, prolog, data):
+            parse_entry(item, data, dtd, writer)
+            writer.flush_full()
+            counter += 1
+            if not counter % 100:
+                metrics.progress(counter, input_position(xml_file))
+        writer.flush()
+
+    metrics.progress(counter, input_position(xml_file), True)
+    xml_file.close()
+    with metrics.phase("commit"):
+        database.commit()
+
+
+def delete_entries(database, entry_ids, last_id):
+    c = database.cursor()
+    c.execute("CREATE TEMP TABLE deleted_entry (id INTEGER PRIMARY KEY)")
+    c.executemany("INSERT INTO deleted_entry (id) VALUES (?)", [(id,) for id in entry_ids])
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = set(row[0] for row in c.fetchall())
+
+    # Replaced entries keep their id, rows added for them have ids
+    # greater than the ones existing before the update and are not removed
+    for name in ("k_ele", "r_ele", "sense"):
+        if dbtable[name] not in tables:
+            continue
+        parent_rows = ("SELECT rowid FROM " + dbtable[name] + " WHERE rowid <= " + str(last_id[name]) +
+                       " AND entry_id IN (SELECT id FROM deleted_entry)")
+        for child in dbtable:
+            if child.startswith(name + "_") and dbtable[child] in tables:
+                c.execute("DELETE FROM " + dbtable[child] + " WHERE " + name + "_id IN (" + parent_rows + ")")
+        c.execute("DELETE FROM " + dbtable[name] + " WHERE rowid IN (" + parent_rows + ")")
+
+    c.execute("DROP TABLE deleted_entry")
+
+
+def check_update_schema(database):
+    c = database.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = set(row[0] for row in c.fetchall())
+
+    # Databases created before --update existed have no entry hash, store
+    # the entity text instead of the entity id and have no normalized
+    # readings, only a full import can rebuild them
+    required = {"entry": "hash", "k_ele": "keb_norm", "r_ele": "reb_norm"}
+    for child in entity_elements:
+        for element, children in entry_elements.items():
+            if child in children:
+                required[element + "_" + child] = child + "_id"
+    if dbtable["entry"] not in tables or dbtable["entity"] not in tables:
+        return False
+    for name, column in required.items():
+        if dbtable[name] not in tables:
+            continue
+        c.execute("PRAGMA table_info(" + dbtable[name] + ")")
+        if column not in [row[1] for row in c.fetchall()]:
+            return False
+
+    return True
+
+
+def update_jmdict(file, database, batch_size):
+    writer = RowWriter(database, dbtable, id_tables, batch_size)
+    xml_file = open_input(file)
+    entities, prolog, data = read_xml_prolog(xml_file, "JMdict")
+    c = database.cursor()
+    stored = dict()
+    changed = []
+    counter = 0
+    added = []
+
+    if prolog == None:
+        print("Invalid JMdict file")
+        xml_file.close()
+        return []
+
+    with metrics.phase("dtd"):
+        dtd = store_entities(database, dbtable["entity"], entities)
+
+    # Databases created before the gloss language was stored
+    c.execute("PRAGMA table_info(" + dbtable["sense_gloss"] + ")")
+    columns = [row[1] for row in c.fetchall()]
+    if len(columns) > 0 and "lang" not in columns:
+        c.execute("ALTER TABLE " + dbtable["sense_gloss"] + " ADD COLUMN lang TEXT DEFAULT 'eng'")
+
+    c.execute("SELECT ent_seq, rowid, hash FROM " + dbtable["entry"])
+    for ent_seq, entry_id, digest in c.fetchall():
+        stored[ent_seq] = (entry_id, digest)
+
+    last_id = dict()
+    for name in id_tables:
+        if name == "entry" or name in xml_elements:
+            last_id[name] = writer.reserve_ids(name, 0)
+
+    metrics.set_input(xml_file)
+    with metrics.phase("parse"):
+        for data, item in iter_entries(xml_file, prolog, data):
+            old = stored.pop(int(item.findtext("ent_seq")), None)
+            if old == None:
+                added.append(parse_entry(item, data, dtd, writer))
+            elif old[1] != entry_hash(data):
+                # The entry row is replaced now while the old child rows
+                # are deleted all together at the end
+                c.execute("DELETE FROM " + dbtable["entry"] + " WHERE rowid = ?", [old[0]])
+                parse_entry(item, data, dtd, writer, old[0])
+                changed.append(old[0])
+            writer.flush_full()
             counter += 1
             if not counter % 100:
-                print("#", end="", flush=True)
+                metrics.progress(counter, input_position(xml_file))
+        writer.flush()
+
+    metrics.progress(counter, input_position(xml_file), True)
+    xml_file.close()
+
+    # Entries still in the stored list are not in the new file anymore
+    removed = [entry_id for entry_id, digest in stored.values()]
+    with metrics.phase("delete"):
+        c.executemany("DELETE FROM " + dbtable["entry"] + " WHERE rowid = ?", [(id,) for id in removed])
+        delete_entries(database, changed + removed, last_id)
+    with metrics.phase("commit"):
+        database.commit()
+
+    print("\n" + str(len(added)) + " entries added, " + str(len(changed)) + " updated, " + str(len(removed)) + " removed")
+
+    return added + changed + removed
+
+
+def reserve_batch_ids(batch, writer):
+    child_tags = {"k_ele": b"<k_ele>", "r_ele": b"<r_ele>", "sense": b"<sense>"}
+    last_id = dict()
+
+    # Ids of every batch are reserved in advance by counting the child
+    # elements, so workers produce exactly the same rows of the serial import
+    for name in writer.last_id:
+        if name == "entry":
+            count = len(batch)
+        else:
+            count = sum(item.count(child_tags[name]) for item in batch)
+        last_id[name] = writer.reserve_ids(name, count)
+
+    return (batch, last_id)
+
+
+def iter_entry_batches(entries, writer, entries_per_batch):
+    batch = []
+
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == entries_per_batch:
+            yield reserve_batch_ids(batch, writer)
+            batch = []
+
+    if len(batch) > 0:
+        yield reserve_batch_ids(batch, writer)
+
+
+worker = dict()
+
+def init_worker(prolog, dtd, languages):
+    worker["prolog"] = prolog
+    worker["dtd"] = dtd
+    gloss_languages.update(languages)
+
+
+def parse_entry_batch(batch):
+    entries, last_id = batch
+    buffer = RowBuffer(last_id)
+    root = ET.fromstring(worker["prolog"] + b"".join(entries) + b"</JMdict>")
+
+    for data, item in zip(entries, root):
+        parse_entry(item, data, worker["dtd"], buffer)
+
+    return (len(entries), buffer.rows, buffer.last_id)
+
+
+def parse_jmdict_parallel(file, database, batch_size, jobs):
+    writer = RowWriter(database, dbtable, id_tables, batch_size)
+    xml_file = open_input(file)
+    entities, prolog, data = read_xml_prolog(xml_file, "JMdict")
+    pending = deque()
+    counter = 0
+
+    valid = True
+
+    if prolog == None:
+        print("Invalid JMdict file")
+        xml_file.close()
+        return False
+
+    with metrics.phase("dtd"):
+        dtd = store_entities(database, dbtable["entity"], entities)
+
+    for name in id_tables:
+        if name == "entry" or name in xml_elements:
+            writer.reserve_ids(name, 0)
+
+    def write_batch(task, last_id):
+        nonlocal counter
+        count, rows, used_id = task.get()
+        # Ids are reserved by counting the child tags in the raw entries, if
+        # the parsed entries used a different number of ids (for example a
+        # tag having spaces or attributes) the rows would reference the wrong
+        # parent rows, so the import is stopped
+        if used_id != last_id:
+            return False
+        for name, table_rows in rows.items():
+            writer.rows[name].extend(table_rows)
+        writer.flush_full()
+        counter += count
+        metrics.progress(counter, input_position(xml_file))
+        return True
+
+    # Batches are sent to the pool in file order and the results are written
+    # back in the same order, only a few batches are queued at the same time
+    # to keep memory usage limited
+    metrics.set_input(xml_file)
+    with metrics.phase("parse"), multiprocessing.Pool(jobs, init_worker, (prolog, dtd, gloss_languages)) as pool:
+        entries = iter_raw_entries(xml_file, data)
+        for batch in iter_entry_batches(entries, writer, entries_per_batch):
+            # After the reservation the writer holds the last ids of the batch
+            pending.append((pool.apply_async(parse_entry_batch, (batch,)), dict(writer.last_id)))
+            if len(pending) >= jobs * 2:
+                valid = write_batch(*pending.popleft())
+                if not valid:
+                    break
+        while valid and pending:
+            valid = write_batch(*pending.popleft())
+        if valid:
+            writer.flush()
+
+    if not valid:
+        print("\nThe elements of an entry don't match the ids reserved for them, import the file without --jobs")
+        xml_file.close()
+        return False
+
+    metrics.progress(counter, input_position(xml_file), True)
+    xml_file.close()
+    with metrics.phase("commit"):
+        database.commit()
+
+    return True
+
+
+def create_gloss_fts(database):
+    table_name = dbtable["gloss_fts"]
+    c = database.cursor()
+
+    # External content FTS5 table over the gloss column, its rowid is the
+    # rowid of the sense_gloss row. Example of ranked search:
+    # select sense.entry_id, gloss.gloss from jmdict_gloss_fts, jmdict_sense_gloss gloss, jmdict_sense sense
+    # where jmdict_gloss_fts match 'water*' and gloss.rowid = jmdict_gloss_fts.rowid and sense.rowid = gloss.sense_id order by rank
+    metrics.start("fts")
+    try:
+        c.execute("DROP TABLE IF EXISTS " + table_name)
+        c.execute("CREATE VIRTUAL TABLE " + table_name + " USING fts5(gloss, content='" + dbtable["sense_gloss"] + "', content_rowid='rowid', "
+                  "tokenize='porter unicode61 remove_diacritics 2', prefix='2 3')")
+        c.execute("INSERT INTO " + table_name + " (" + table_name + ") VALUES ('rebuild')")
+    except sqlite3.OperationalError as error:
+        print("\nUnable to create full text index: " + str(error))
+        return
+    finally:
+        metrics.stop()
 
     database.commit()
 
 
+def write_entry_blobs(database, entry_ids):
+    c = database.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    names = set(row[0] for row in c.fetchall())
+    tables = dict((name, table) for name, table in dbtable.items() if table in names)
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS blob_entry_id (id INTEGER PRIMARY KEY)")
+
+    for start in range(0, len(entry_ids), blob_batch_size):
+        entries = read_entries(database, tables, entry_elements, entry_columns, entity_elements, "blob_entry_id", entry_ids[start:start + blob_batch_size])
+        rows = []
+        for entry_id, entry in entries.items():
+            data = json.dumps(entry, ensure_ascii=False, separators=(",", ":")).encode("utf8")
+            rows.append((entry_id, entry["ent_seq"], zlib.compress(data, 9)))
+        c.executemany("INSERT OR REPLACE INTO " + dbtable["entry_blob"] + " (entry_id, ent_seq, data) VALUES (?, ?, ?)", rows)
+
+    c.execute("DROP TABLE temp.blob_entry_id")
+
+
+def create_entry_blobs(database):
+    table_name = dbtable["entry_blob"]
+    c = database.cursor()
+
+    # Entries are assembled back from the normalized tables through the
+    # entry_id indexes, after an import they have to be created now
+    create_indexes(database)
+
+    with metrics.phase("blobs"):
+        c.execute("DROP TABLE IF EXISTS " + table_name)
+        c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER PRIMARY KEY, ent_seq INTEGER, data BLOB)")
+        c.execute("SELECT rowid FROM " + dbtable["entry"] + " ORDER BY rowid")
+        write_entry_blobs(database, [row[0] for row in c.fetchall()])
+        c.execute("CREATE INDEX " + table_name + "_ent_seq_index ON " + table_name + " (ent_seq)")
+        database.commit()
+
+
+def update_entry_blobs(database, entry_ids):
+    c = database.cursor()
+
+    # Blobs of the added and changed entries are written again, the ones
+    # of the removed entries are only deleted
+    with metrics.phase("blobs"):
+        c.executemany("DELETE FROM " + dbtable["entry_blob"] + " WHERE entry_id = ?", [(id,) for id in entry_ids])
+        write_entry_blobs(database, sorted(entry_ids))
+        database.commit()
+
+
 def main():
     args = parse_cmdline()
+    sqltrace.enabled = args.tracesql
     appendtables = False
 
     if args.appendtables:
         appendtables = True
 
-    print("Create database...", end="\n", flush=True)
-    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables)
-
-    print("Start importing JMDict data:", end="", flush=True)
-    parse_jmdict(args.jmdictfile, database)
+    if args.languages:
+        gloss_languages.update(lang.strip() for lang in args.languages.split(",") if lang.strip() != "")
+
+    if args.update:
+        database = open_database(args.sqlitefile.strip(), args.dbtableprefix.strip())
+        if database == None:
+            print("Database file not found")
+            return
+        if not check_update_schema(database):
+            print("Database created by an older version of JMdictToSQLite, it can't be updated: import it again without --update")
+            database.close()
+            return
+        print("Start updating JMDict data:", end="\n", flush=True)
+        entry_ids = update_jmdict(args.jmdictfile, database, args.batchsize)
+        c = database.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE name = ?", [dbtable["entry_blob"]])
+        if c.fetchone() != None:
+            print("Update entry blobs...", end="\n", flush=True)
+            update_entry_blobs(database, entry_ids)
+        elif args.entryblobs:
+            print("Create entry blobs...", end="\n", flush=True)
+            create_entry_blobs(database)
+        c.execute("SELECT name FROM sqlite_master WHERE name = ?", [dbtable["gloss_fts"]])
+        if args.fts or c.fetchone() != None:
+            print("Rebuild full text index...", end="\n", flush=True)
+            create_gloss_fts(database)
+        metrics.count_rows(database, dbtable.values())
+        close_database(database)
+        metrics.report(args.metricsfile)
+        if args.tracesql:
+            sqltrace.report()
+            sqltrace.audit(dbfile["name"], audit_queries, dbtable)
+        return
 
-    database.close()
+    print("Create database...", end="\n", flush=True)
+    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables, args.fastbuild)
+
+    # With a single CPU the workers would only compete with the main process
+    jobs = args.jobs
+    if jobs > 1 and os.cpu_count() == 1:
+        print("Only one CPU available, --jobs is ignored")
+        jobs = 1
+
+    print("Start importing JMDict data:", end="\n", flush=True)
+    if jobs > 1:
+        if not parse_jmdict_parallel(args.jmdictfile, database, args.batchsize, jobs):
+            database.close()
+            return
+    else:
+        parse_jmdict(args.jmdictfile, database, args.batchsize)
+
+    if args.entryblobs:
+        print("\nCreate entry blobs...", end="\n", flush=True)
+        create_entry_blobs(database)
+
+    if args.fts and "gloss" in xml_elements:
+        print("\nCreate full text index...", end="\n", flush=True)
+        create_gloss_fts(database)
+
+    metrics.count_rows(database, dbtable.values())
+    close_database(database)
+    metrics.report(args.metricsfile)
+    if args.tracesql:
+        sqltrace.report()
+        sqltrace.audit(dbfile["name"], audit_queries, dbtable)
 
     
 if __name__ == '__main__':
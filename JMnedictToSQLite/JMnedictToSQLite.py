@@ -1,23 +1,67 @@
 
 from argparse import ArgumentParser, FileType, Action
-import xml.etree.ElementTree as ET
 import sqlite3
 import sys
 import os
-import codecs
+import shutil
+import json
+import zlib
+
+# Helpers shared by all the converters, see SQLiteImport.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "SQLiteImport"))
+from SQLiteImport import metrics, sqltrace, fast_build_pragmas, store_entities, read_entries, normalize_reading, open_input, input_position, iter_root_children, read_xml_prolog, iter_xml_events
+
+# Lookups done by a typical dictionary client, with --tracesql the query
+# plan of each one is checked for full table scans
+audit_queries = [
+    "SELECT entry_id FROM {k_ele} WHERE keb = ?",
+    "SELECT entry_id FROM {r_ele} WHERE reb = ?",
+    "SELECT entry_id FROM {k_ele} WHERE keb_norm >= ? AND keb_norm < ?",
+    "SELECT entry_id FROM {r_ele} WHERE reb_norm >= ? AND reb_norm < ?",
+    "SELECT rowid, keb FROM {k_ele} WHERE entry_id = ?",
+    "SELECT rowid, reb FROM {r_ele} WHERE entry_id = ?",
+    "SELECT rowid FROM {trans} WHERE entry_id = ?",
+    "SELECT trans_det FROM {trans_trans_det} WHERE trans_id = ?",
+    "SELECT trans_id FROM {trans_name_type} WHERE name_type_id = (SELECT rowid FROM {entity} WHERE code = ?)",
+    "SELECT data FROM {entry_blob} WHERE entry_id = ?",
+    "SELECT data FROM {entry_blob} WHERE ent_seq = ?"
+    ]
+
+# Child tables of every entry element stored into the entry blobs, values
+# of the entity children are stored as their DTD code
+entry_elements = {
+    "k_ele": ["ke_inf", "ke_pri"],
+    "r_ele": ["re_restr", "re_inf", "re_pri"],
+    "trans": ["name_type", "xref", "trans_det"]
+    }
+
+entity_elements = ["ke_inf", "re_inf", "name_type"]
+
+# Value columns of the element tables stored into the entry blobs
+entry_columns = {"k_ele": ["keb"], "r_ele": ["reb"]}
+
+# Number of entries read back from the tables for each batch of blobs
+blob_batch_size = 1000
 
 dbtable = dict()
+dbindex = list()
+dbfile = dict()
 
 def parse_cmdline():
     parser = ArgumentParser()
-    parser.add_argument("--jmnedictfile", help="path to the .xml JMnedict file", default="JMnedict.xml")
+    parser.add_argument("--jmnedictfile", help="path to the .xml JMnedict file (gzip, xz or bzip2 compressed files are accepted)", default="JMnedict.xml")
     parser.add_argument("--sqlitefile", help="path to the sqlite database to create", required=True)
     parser.add_argument("--dbtableprefix", help="prefix of db tables (ex. jmnedict)", default="jmnedict")
     parser.add_argument("--appendtables", help="append tables into an existing database file", action="store_true")
+    parser.add_argument("--fastbuild", "--fast-build", help="build the database with bulk load settings and create indexes at the end", action="store_true")
+    parser.add_argument("--metricsfile", help="write the import metrics (phase times, rows per table, peak memory) to this json file")
+    parser.add_argument("--tracesql", "--trace-sql", help="report the time spent by every sql statement and check the query plans of the common lookups", action="store_true")
+    parser.add_argument("--fts", help="build a FTS5 full text index over the translations", action="store_true")
+    parser.add_argument("--entryblobs", "--entry-blobs", help="also store every entry as a single compressed json row, to read a full entry with one query", action="store_true")
     return parser.parse_args()
 
 
-def create_database(name, prefix, append):
+def create_database(name, prefix, append, fastbuild):
     sqlitefile = name
     global dbtable
 
@@ -25,6 +69,7 @@ def create_database(name, prefix, append):
         prefix += "_"
 
     dbtable["entry"] = prefix + "entry"
+    dbtable["entity"] = prefix + "entity"
     dbtable["k_ele"] = prefix + "k_ele"
     dbtable["k_ele_ke_inf"] = prefix + "k_ele_ke_inf"
     dbtable["k_ele_ke_pri"] = prefix + "k_ele_ke_pri"
@@ -36,67 +81,121 @@ def create_database(name, prefix, append):
     dbtable["trans_name_type"] = prefix + "trans_name_type"
     dbtable["trans_xref"] = prefix + "trans_xref"
     dbtable["trans_trans_det"] = prefix + "trans_trans_det"
+    dbtable["trans_det_fts"] = prefix + "trans_det_fts"
+    dbtable["entry_blob"] = prefix + "entry_blob"
 
     if len(sqlitefile) < 3 or sqlitefile[-3:] != ".db":
         sqlitefile = sqlitefile + ".db"
 
-    if append == False and os.path.exists(sqlitefile):
+    dbfile["name"] = sqlitefile
+    dbfile["fastbuild"] = fastbuild
+
+    if fastbuild:
+        # Database is built into a temporary file renamed only at the end
+        sqlitefile = sqlitefile + ".tmp"
+        if os.path.exists(sqlitefile):
+            os.remove(sqlitefile)
+        if append == True and os.path.exists(dbfile["name"]):
+            shutil.copyfile(dbfile["name"], sqlitefile)
+    elif append == False and os.path.exists(sqlitefile):
         os.remove(sqlitefile)
 
-    database = sqlite3.connect(sqlitefile)
+    dbfile["build"] = sqlitefile
+    database = sqltrace.connect(sqlitefile)
     c = database.cursor()
 
+    if fastbuild:
+        for pragma in fast_build_pragmas:
+            c.execute(pragma)
+
     c.execute("CREATE TABLE " + dbtable["entry"] + " (ent_seq INTEGER DEFAULT 0)")
 
+    table_name = dbtable["entity"]
+    c.execute("CREATE TABLE " + table_name + " (code TEXT, description TEXT)")
+    dbindex.append("CREATE INDEX " + table_name + "_code_index ON " + table_name + " (code)")
+
     table_name = dbtable["k_ele"]
-    c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER, keb TEXT DEFAULT '')")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
-    c.execute("CREATE INDEX " + table_name + "_keb_index ON " + table_name + " (keb)")
+    c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER, keb TEXT DEFAULT '', keb_norm TEXT DEFAULT '')")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_keb_index ON " + table_name + " (keb)")
+    dbindex.append("CREATE INDEX " + table_name + "_keb_norm_index ON " + table_name + " (keb_norm, entry_id)")
 
     table_name = dbtable["k_ele_ke_inf"]
-    c.execute("CREATE TABLE " + table_name + " (k_ele_id INTEGER, ke_inf TEXT)")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (k_ele_id)")
+    c.execute("CREATE TABLE " + table_name + " (k_ele_id INTEGER, ke_inf_id INTEGER)")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (k_ele_id)")
 
     table_name = dbtable["k_ele_ke_pri"]
     c.execute("CREATE TABLE " + table_name + " (k_ele_id INTEGER, ke_pri TEXT)")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (k_ele_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (k_ele_id)")
 
     table_name = dbtable["r_ele"]
-    c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER, reb TEXT DEFAULT '')")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
-    c.execute("CREATE INDEX " + table_name + "_reb_index ON " + table_name + " (reb)")
+    c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER, reb TEXT DEFAULT '', reb_norm TEXT DEFAULT '')")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_reb_index ON " + table_name + " (reb)")
+    # The normalized columns are indexed together with entry_id for as you type
+    # prefix searches using a range scan, for example (prefix 'かん'):
+    # select distinct entry_id from jmnedict_r_ele where reb_norm >= 'かん' and reb_norm < 'かゔ'
+    dbindex.append("CREATE INDEX " + table_name + "_reb_norm_index ON " + table_name + " (reb_norm, entry_id)")
 
     table_name = dbtable["r_ele_re_restr"]
     c.execute("CREATE TABLE " + table_name + " (r_ele_id INTEGER, re_restr TEXT)")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
 
     table_name = dbtable["r_ele_re_inf"]
-    c.execute("CREATE TABLE " + table_name + " (r_ele_id INTEGER, re_inf TEXT)")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
+    c.execute("CREATE TABLE " + table_name + " (r_ele_id INTEGER, re_inf_id INTEGER)")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
 
     table_name = dbtable["r_ele_re_pri"]
     c.execute("CREATE TABLE " + table_name + " (r_ele_id INTEGER, re_pri TEXT)")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (r_ele_id)")
 
     table_name = dbtable["trans"]
     c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER)")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (entry_id)")
 
     table_name = dbtable["trans_name_type"]
-    c.execute("CREATE TABLE " + table_name + " (trans_id INTEGER, name_type TEXT)")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (trans_id)")
+    c.execute("CREATE TABLE " + table_name + " (trans_id INTEGER, name_type_id INTEGER)")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (trans_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_name_type_index ON " + table_name + " (name_type_id, trans_id)")
 
     table_name = dbtable["trans_xref"]
     c.execute("CREATE TABLE " + table_name + " (trans_id INTEGER, xref TEXT)")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (trans_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (trans_id)")
 
     table_name = dbtable["trans_trans_det"]
     c.execute("CREATE TABLE " + table_name + " (trans_id INTEGER, trans_det TEXT)")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (trans_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (trans_id)")
+
+    if not fastbuild:
+        create_indexes(database)
 
     return database
 
 
+def create_indexes(database):
+    c = database.cursor()
+
+    with metrics.phase("index"):
+        for query in dbindex:
+            c.execute(query)
+
+    dbindex.clear()
+
+
+def close_database(database):
+    # In fast build mode tables are filled without indexes, all of them
+    # are created in a single pass once the data has been imported
+    if dbfile["fastbuild"]:
+        create_indexes(database)
+
+    with metrics.phase("commit"):
+        database.commit()
+    database.close()
+
+    if dbfile["fastbuild"]:
+        os.replace(dbfile["build"], dbfile["name"])
+
+
 def parse_k_ele(k_ele, entry_id, dtd, database):
     c = database.cursor()
     c.execute("INSERT INTO " + dbtable["k_ele"] + " (entry_id) VALUES (?)", [entry_id])
@@ -104,9 +203,9 @@ def parse_k_ele(k_ele, entry_id, dtd, database):
 
     for item in k_ele:
         if item.tag == "keb":
-            c.execute("UPDATE " + dbtable["k_ele"] + " SET keb = ? WHERE rowid = ?", (item.text, k_ele_id))
+            c.execute("UPDATE " + dbtable["k_ele"] + " SET keb = ?, keb_norm = ? WHERE rowid = ?", (item.text, normalize_reading(item.text), k_ele_id))
         elif item.tag == "ke_inf":
-            c.execute("INSERT INTO " + dbtable["k_ele_ke_inf"] + " (k_ele_id, ke_inf) VALUES (?, ?)", (k_ele_id, dtd[item.text]))
+            c.execute("INSERT INTO " + dbtable["k_ele_ke_inf"] + " (k_ele_id, ke_inf_id) VALUES (?, ?)", (k_ele_id, dtd[item.text]))
         elif item.tag == "ke_pri":
             c.execute("INSERT INTO " + dbtable["k_ele_ke_pri"] + " (k_ele_id, ke_pri) VALUES (?, ?)", (k_ele_id, item.text))
 
@@ -118,11 +217,11 @@ def parse_r_ele(r_ele, entry_id, dtd, database):
 
     for item in r_ele:
         if item.tag == "reb":
-            c.execute("UPDATE " + dbtable["r_ele"] + " SET reb = ? WHERE rowid = ?", (item.text, r_ele_id))
+            c.execute("UPDATE " + dbtable["r_ele"] + " SET reb = ?, reb_norm = ? WHERE rowid = ?", (item.text, normalize_reading(item.text), r_ele_id))
         elif item.tag == "re_restr":
             c.execute("INSERT INTO " + dbtable["r_ele_re_restr"] + " (r_ele_id, re_restr) VALUES (?, ?)", (r_ele_id, item.text))
         elif item.tag == "re_inf":
-            c.execute("INSERT INTO " + dbtable["r_ele_re_inf"] + " (r_ele_id, re_inf) VALUES (?, ?)", (r_ele_id, dtd[item.text]))
+            c.execute("INSERT INTO " + dbtable["r_ele_re_inf"] + " (r_ele_id, re_inf_id) VALUES (?, ?)", (r_ele_id, dtd[item.text]))
         elif item.tag == "re_pri":
             c.execute("INSERT INTO " + dbtable["r_ele_re_pri"] + " (r_ele_id, re_pri) VALUES (?, ?)", (r_ele_id, item.text))
 
@@ -134,7 +233,7 @@ def parse_trans(trans, entry_id, dtd, database):
 
     for item in trans:
         if item.tag == "name_type":
-            c.execute("INSERT INTO " + dbtable["trans_name_type"] + " (trans_id, name_type) VALUES (?, ?)", (trans_id, dtd[item.text]))
+            c.execute("INSERT INTO " + dbtable["trans_name_type"] + " (trans_id, name_type_id) VALUES (?, ?)", (trans_id, dtd[item.text]))
         elif item.tag == "xref":
             c.execute("INSERT INTO " + dbtable["trans_xref"] + " (trans_id, xref) VALUES (?, ?)", (trans_id, item.text))
         elif item.tag == "trans_det":
@@ -157,59 +256,121 @@ def parse_entry(entry, dtd, database):
             parse_trans(item, entry_id, dtd, database)
 
 
-def load_xml_dtd(file):
-    xml_file = codecs.open(file, "r", "utf8")
-    value_list = []
-    code_list = []
-
-    # Currently the only way I found for extract the xml DTD list
-    # is to manually get entity lines and make a small parsing
-    for line in xml_file:
-        if len(line) >= 2 and line[0:2] == "]>":
-            break
-        if len(line) >= 15 and line[0:8] == "<!ENTITY":
-            code_list.append(line.split(" ")[1])
-            value_list.append(line.split("\"")[1])
-            
-    xml_file.close()
-
-    return dict(zip(value_list, code_list))
-
-
 def parse_jmnedict(file, database):
-    dtd = load_xml_dtd(file)
-    tree = ET.parse(file)
-    root = tree.getroot()
+    xml_file = open_input(file)
+    entities, prolog, data = read_xml_prolog(xml_file, "JMnedict")
     counter = 0
 
-    if root.tag != "JMnedict":
+    if prolog == None:
         print("Invalid JMnedict file")
+        xml_file.close()
         return
 
-    for item in root:
-        if item.tag == "entry":
-            parse_entry(item, dtd, database)
-            counter += 1
-            if not counter % 100:
-                print("#", end="", flush=True)
+    with metrics.phase("dtd"):
+        dtd = store_entities(database, dbtable["entity"], entities)
+    context = iter_xml_events(xml_file, prolog + data)
+    event, root = next(context)
+
+    # Rows are inserted while parsing so the parse time includes the inserts
+    metrics.set_input(xml_file)
+    with metrics.phase("parse"):
+        for item in iter_root_children(context, root):
+            if item.tag == "entry":
+                parse_entry(item, dtd, database)
+                counter += 1
+                if not counter % 100:
+                    metrics.progress(counter, input_position(xml_file))
+
+    metrics.progress(counter, input_position(xml_file), True)
+    xml_file.close()
+    with metrics.phase("commit"):
+        database.commit()
+
+
+def create_trans_det_fts(database):
+    table_name = dbtable["trans_det_fts"]
+    c = database.cursor()
+
+    # External content FTS5 table over the trans_det column, its rowid is the
+    # rowid of the trans_trans_det row. Example of ranked search:
+    # select trans.entry_id, det.trans_det from jmnedict_trans_det_fts, jmnedict_trans_trans_det det, jmnedict_trans trans
+    # where jmnedict_trans_det_fts match 'tokyo' and det.rowid = jmnedict_trans_det_fts.rowid and trans.rowid = det.trans_id order by rank
+    metrics.start("fts")
+    try:
+        c.execute("DROP TABLE IF EXISTS " + table_name)
+        c.execute("CREATE VIRTUAL TABLE " + table_name + " USING fts5(trans_det, content='" + dbtable["trans_trans_det"] + "', content_rowid='rowid', "
+                  "tokenize='porter unicode61 remove_diacritics 2', prefix='2 3')")
+        c.execute("INSERT INTO " + table_name + " (" + table_name + ") VALUES ('rebuild')")
+    except sqlite3.OperationalError as error:
+        print("\nUnable to create full text index: " + str(error))
+        return
+    finally:
+        metrics.stop()
 
     database.commit()
 
 
+def write_entry_blobs(database, entry_ids):
+    c = database.cursor()
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS blob_entry_id (id INTEGER PRIMARY KEY)")
+
+    for start in range(0, len(entry_ids), blob_batch_size):
+        entries = read_entries(database, dbtable, entry_elements, entry_columns, entity_elements, "blob_entry_id", entry_ids[start:start + blob_batch_size])
+        rows = []
+        for entry_id, entry in entries.items():
+            data = json.dumps(entry, ensure_ascii=False, separators=(",", ":")).encode("utf8")
+            rows.append((entry_id, entry["ent_seq"], zlib.compress(data, 9)))
+        c.executemany("INSERT OR REPLACE INTO " + dbtable["entry_blob"] + " (entry_id, ent_seq, data) VALUES (?, ?, ?)", rows)
+
+    c.execute("DROP TABLE temp.blob_entry_id")
+
+
+def create_entry_blobs(database):
+    table_name = dbtable["entry_blob"]
+    c = database.cursor()
+
+    # Entries are assembled back from the normalized tables through the
+    # entry_id indexes, with --fastbuild they have to be created now
+    if dbfile["fastbuild"]:
+        create_indexes(database)
+
+    with metrics.phase("blobs"):
+        c.execute("DROP TABLE IF EXISTS " + table_name)
+        c.execute("CREATE TABLE " + table_name + " (entry_id INTEGER PRIMARY KEY, ent_seq INTEGER, data BLOB)")
+        c.execute("SELECT rowid FROM " + dbtable["entry"] + " ORDER BY rowid")
+        write_entry_blobs(database, [row[0] for row in c.fetchall()])
+        c.execute("CREATE INDEX " + table_name + "_ent_seq_index ON " + table_name + " (ent_seq)")
+        database.commit()
+
+
 def main():
     args = parse_cmdline()
+    sqltrace.enabled = args.tracesql
     appendtables = False
 
     if args.appendtables:
         appendtables = True
 
     print("Create database...", end="\n", flush=True)
-    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables)
+    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables, args.fastbuild)
 
-    print("Start importing JMnedict data:", end="", flush=True)
+    print("Start importing JMnedict data:", end="\n", flush=True)
     parse_jmnedict(args.jmnedictfile, database)
 
-    database.close()
+    if args.entryblobs:
+        print("\nCreate entry blobs...", end="\n", flush=True)
+        create_entry_blobs(database)
+
+    if args.fts:
+        print("\nCreate full text index...", end="\n", flush=True)
+        create_trans_det_fts(database)
+
+    metrics.count_rows(database, dbtable.values())
+    close_database(database)
+    metrics.report(args.metricsfile)
+    if args.tracesql:
+        sqltrace.report()
+        sqltrace.audit(dbfile["name"], audit_queries, dbtable)
 
     
 if __name__ == '__main__':
@@ -0,0 +1,294 @@
+import sqlite3
+import math
+import re
+
+# Example use:
+#   paths = KanjiVGPaths("kanjivg.db")
+#   for points in paths.stroke_points("語"):
+#       ...
+#
+# Stroke paths are stored as svg path text or, if the database was built
+# with --encodepaths, as blobs: a first byte with the number of decimals
+# kept, then every segment as its absolute command letter followed by the
+# coordinates quantized to those decimals and written as zigzag varint
+# deltas from the start point of the segment. Paths the importer can't
+# encode (the ones having arcs) are kept as text. Both forms are decoded
+# into the same list of (command, coordinates) tuples with absolute
+# coordinates and commands among M, L, H, V, C, S, Q, T, A and Z, segments
+# with unknown commands or missing coordinates are skipped.
+#
+# path_points() converts a path into one list of (x, y) points for every
+# subpath, curves and arcs are flattened into the given number of segments.
+
+path_commands = {"M": 2, "L": 2, "H": 1, "V": 1, "C": 6, "S": 4, "Q": 4, "T": 2, "A": 7, "Z": 0}
+path_token = re.compile(r"[A-Za-z]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+def read_varint(data, index):
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[index]
+        index += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+
+    if value & 1:
+        return -(value >> 1) - 1, index
+    return value >> 1, index
+
+
+def decode_blob(data):
+    scale = 10 ** data[0]
+    segments = []
+    # Current and subpath start points, quantized
+    x = y = start_x = start_y = 0
+    index = 1
+
+    while index < len(data):
+        command = chr(data[index])
+        index += 1
+        if command == "Z":
+            segments.append(("Z", []))
+            x, y = start_x, start_y
+            continue
+
+        coordinates = []
+        for number in range(path_commands[command]):
+            value, index = read_varint(data, index)
+            if command == "H" or (command != "V" and number % 2 == 0):
+                coordinates.append(x + value)
+            else:
+                coordinates.append(y + value)
+        if command == "H":
+            x = coordinates[-1]
+        elif command == "V":
+            y = coordinates[-1]
+        else:
+            x, y = coordinates[-2], coordinates[-1]
+        if command == "M":
+            start_x, start_y = x, y
+
+        segments.append((command, [value / scale for value in coordinates]))
+
+    return segments
+
+
+def decode_text(d):
+    tokens = path_token.findall(d)
+    segments = []
+    x = y = start_x = start_y = 0.0
+    command = None
+    index = 0
+
+    while index < len(tokens):
+        if tokens[index].isalpha():
+            command = tokens[index]
+            index += 1
+        if command == None or command.upper() not in path_commands:
+            # Numbers up to the next command are skipped
+            command = None
+            while index < len(tokens) and not tokens[index].isalpha():
+                index += 1
+            continue
+        upper = command.upper()
+
+        if upper == "Z":
+            segments.append(("Z", []))
+            x, y = start_x, start_y
+            command = None
+            continue
+
+        values = tokens[index:index + path_commands[upper]]
+        if len(values) != path_commands[upper] or any(value.isalpha() for value in values):
+            command = None
+            continue
+        index += len(values)
+
+        coordinates = [float(value) for value in values]
+        if command.islower():
+            # Radii, rotation and flags of the arcs are never relative
+            first = 5 if upper == "A" else 0
+            for number in range(first, len(coordinates)):
+                if upper == "H" or (upper != "V" and (number - first) % 2 == 0):
+                    coordinates[number] += x
+                else:
+                    coordinates[number] += y
+
+        if upper == "H":
+            x = coordinates[-1]
+        elif upper == "V":
+            y = coordinates[-1]
+        else:
+            x, y = coordinates[-2], coordinates[-1]
+        if upper == "M":
+            start_x, start_y = x, y
+            command = "l" if command == "m" else "L"
+
+        segments.append((upper, coordinates))
+
+    return segments
+
+
+def decode_path(path):
+    if path == None:
+        return []
+    if isinstance(path, str):
+        return decode_text(path)
+    return decode_blob(path)
+
+
+def path_text(path):
+    # Svg path text with absolute commands of a path in any of the two forms
+    def number(value):
+        text = ("%.4f" % value).rstrip("0").rstrip(".")
+        return "0" if text == "-0" else text
+
+    return "".join(command + ",".join(number(value) for value in coordinates)
+                   for command, coordinates in decode_path(path))
+
+
+def arc_points(x, y, coordinates, curve_segments):
+    rx, ry, angle, large_arc, sweep, end_x, end_y = coordinates
+    rx = abs(rx)
+    ry = abs(ry)
+
+    if rx == 0 or ry == 0 or (x == end_x and y == end_y):
+        return [(end_x, end_y)]
+
+    # Center of the ellipse from the end points, as in the svg specification
+    # (implementation notes, conversion from endpoint to center)
+    cos_phi = math.cos(math.radians(angle))
+    sin_phi = math.sin(math.radians(angle))
+    dx = (x - end_x) / 2
+    dy = (y - end_y) / 2
+    x1 = cos_phi * dx + sin_phi * dy
+    y1 = -sin_phi * dx + cos_phi * dy
+    scale = (x1 * x1) / (rx * rx) + (y1 * y1) / (ry * ry)
+    if scale > 1:
+        rx *= math.sqrt(scale)
+        ry *= math.sqrt(scale)
+    numerator = rx * rx * ry * ry - rx * rx * y1 * y1 - ry * ry * x1 * x1
+    denominator = rx * rx * y1 * y1 + ry * ry * x1 * x1
+    factor = math.sqrt(max(0, numerator / denominator))
+    if (large_arc != 0) == (sweep != 0):
+        factor = -factor
+    center_x1 = factor * rx * y1 / ry
+    center_y1 = -factor * ry * x1 / rx
+    center_x = cos_phi * center_x1 - sin_phi * center_y1 + (x + end_x) / 2
+    center_y = sin_phi * center_x1 + cos_phi * center_y1 + (y + end_y) / 2
+
+    start = math.atan2((y1 - center_y1) / ry, (x1 - center_x1) / rx)
+    delta = math.atan2((-y1 - center_y1) / ry, (-x1 - center_x1) / rx) - start
+    if sweep != 0 and delta < 0:
+        delta += 2 * math.pi
+    elif sweep == 0 and delta > 0:
+        delta -= 2 * math.pi
+
+    points = []
+    for step in range(1, curve_segments):
+        t = start + delta * step / curve_segments
+        points.append((center_x + rx * math.cos(t) * cos_phi - ry * math.sin(t) * sin_phi,
+                       center_y + rx * math.cos(t) * sin_phi + ry * math.sin(t) * cos_phi))
+    points.append((end_x, end_y))
+
+    return points
+
+
+def path_points(path, curve_segments=8):
+    subpaths = []
+    points = None
+    x = y = 0.0
+    # Last control point, used for the reflection of S and T
+    control = None
+
+    for command, coordinates in decode_path(path):
+        if command == "M":
+            x, y = coordinates
+            points = [(x, y)]
+            subpaths.append(points)
+            control = None
+            continue
+        if points == None:
+            points = [(x, y)]
+            subpaths.append(points)
+
+        if command == "Z":
+            x, y = points[0]
+            points.append((x, y))
+            points = None
+            control = None
+            continue
+        if command in "LHV":
+            if command == "H":
+                x = coordinates[0]
+            elif command == "V":
+                y = coordinates[0]
+            else:
+                x, y = coordinates
+            points.append((x, y))
+            control = None
+            continue
+
+        if command == "A":
+            points.extend(arc_points(x, y, coordinates, curve_segments))
+            x, y = coordinates[5], coordinates[6]
+            control = None
+            continue
+        if command in "ST":
+            if control != None and control[0] == ("C" if command == "S" else "Q"):
+                first = (2 * x - control[1], 2 * y - control[2])
+            else:
+                first = (x, y)
+            coordinates = list(first) + coordinates
+        if command in "CS":
+            x1, y1, x2, y2, x3, y3 = coordinates
+            for step in range(1, curve_segments + 1):
+                t = step / curve_segments
+                s = 1 - t
+                points.append((s * s * s * x + 3 * s * s * t * x1 + 3 * s * t * t * x2 + t * t * t * x3,
+                               s * s * s * y + 3 * s * s * t * y1 + 3 * s * t * t * y2 + t * t * t * y3))
+            control = ("C", x2, y2)
+        else:
+            x1, y1, x3, y3 = coordinates
+            for step in range(1, curve_segments + 1):
+                t = step / curve_segments
+                s = 1 - t
+                points.append((s * s * x + 2 * s * t * x1 + t * t * x3,
+                               s * s * y + 2 * s * t * y1 + t * t * y3))
+            control = ("Q", x1, y1)
+        x, y = x3, y3
+
+    return subpaths
+
+
+class KanjiVGPaths:
+    def __init__(self, sqlitefile, prefix="kanjivg"):
+        if(prefix != ""):
+            prefix += "_"
+
+        self.prefix = prefix
+        self.database = sqlite3.connect(sqlitefile)
+
+    def close(self):
+        self.database.close()
+
+    def table(self, name):
+        return self.prefix + name
+
+    def strokes(self, kanji):
+        c = self.database.cursor()
+
+        # Returns (sequence, type, path) of every stroke in drawing order
+        c.execute("SELECT strokes.sequence, strokes.type, strokes.path FROM " + self.table("kanji") + " kanji JOIN " +
+                  self.table("groups") + " groups ON groups.kanji_id = kanji.rowid JOIN " +
+                  self.table("strokes") + " strokes ON strokes.group_id = groups.rowid "
+                  "WHERE kanji.character = ? ORDER BY strokes.sequence", [kanji])
+        return c.fetchall()
+
+    def stroke_points(self, kanji, curve_segments=8):
+        # One list of points for every stroke, subpaths are joined
+        return [[point for subpath in path_points(path, curve_segments) for point in subpath]
+                for sequence, type, path in self.strokes(kanji)]
@@ -0,0 +1,138 @@
+import sqlite3
+from KanjiVGPaths import path_points
+
+# Example use:
+#   build_features("kanjivg.db", "kanjivg_strokes.npz")
+#   recognizer = KanjiVGRecognizer("kanjivg_strokes.npz")
+#   candidates = recognizer.recognize([[(x, y), (x, y), ...], ...])
+#
+# Every kanji is described by its strokes in drawing order, each stroke by
+# six numbers: start point, end point and unit direction from start to end.
+# Points are normalized to the bounding box of the whole kanji (centered,
+# longest side 1) so the drawn input can have any size and position. The
+# features of all the kanji are a single float32 array of shape (kanji,
+# max strokes, 6) with zeros after the last stroke, saved in a .npz file
+# with the kanji characters, ids and stroke counts.
+#
+# The distance of a kanji from the drawn input is the sum over the strokes
+# of the squared feature differences plus a penalty for every stroke more
+# or less than the input, computed for all the kanji at once with numpy.
+
+stroke_features = 6
+missing_stroke_penalty = 1.0
+
+def normalize_strokes(strokes):
+    # strokes is a list of point lists, returns the start and end points of
+    # every stroke normalized to the bounding box of all the points
+    points = [point for stroke in strokes for point in stroke]
+    if len(points) == 0:
+        return []
+
+    min_x = min(x for x, y in points)
+    max_x = max(x for x, y in points)
+    min_y = min(y for x, y in points)
+    max_y = max(y for x, y in points)
+    center_x = (min_x + max_x) / 2
+    center_y = (min_y + max_y) / 2
+    size = max(max_x - min_x, max_y - min_y)
+    if size == 0:
+        size = 1
+
+    return [((stroke[0][0] - center_x) / size, (stroke[0][1] - center_y) / size,
+             (stroke[-1][0] - center_x) / size, (stroke[-1][1] - center_y) / size)
+            for stroke in strokes if len(stroke) > 0]
+
+
+def strokes_features(strokes):
+    features = []
+
+    for start_x, start_y, end_x, end_y in normalize_strokes(strokes):
+        length = ((end_x - start_x) ** 2 + (end_y - start_y) ** 2) ** 0.5
+        if length > 0:
+            direction = ((end_x - start_x) / length, (end_y - start_y) / length)
+        else:
+            direction = (0.0, 0.0)
+        features.append((start_x, start_y, end_x, end_y) + direction)
+
+    return features
+
+
+def build_features(sqlitefile, npzfile, prefix="kanjivg", curve_segments=4):
+    import numpy
+
+    if(prefix != ""):
+        prefix += "_"
+
+    database = sqlite3.connect(sqlitefile)
+    c = database.cursor()
+    c.execute("SELECT kanji.rowid, kanji.character, strokes.path FROM " + prefix + "kanji kanji JOIN " +
+              prefix + "groups groups ON groups.kanji_id = kanji.rowid JOIN " +
+              prefix + "strokes strokes ON strokes.group_id = groups.rowid "
+              "ORDER BY kanji.rowid, strokes.sequence")
+
+    kanji_ids = []
+    kanji = []
+    features = []
+    strokes = []
+    for kanji_id, character, path in c:
+        if len(kanji_ids) == 0 or kanji_ids[-1] != kanji_id:
+            if len(strokes) > 0:
+                features.append(strokes_features(strokes))
+            kanji_ids.append(kanji_id)
+            kanji.append(character)
+            strokes = []
+        # Subpaths of a stroke are joined
+        strokes.append([point for subpath in path_points(path, curve_segments) for point in subpath])
+    if len(strokes) > 0:
+        features.append(strokes_features(strokes))
+    database.close()
+
+    counts = numpy.array([len(item) for item in features], dtype=numpy.int32)
+    matrix = numpy.zeros((len(features), counts.max() if len(features) > 0 else 0, stroke_features), dtype=numpy.float32)
+    for index, item in enumerate(features):
+        if len(item) > 0:
+            matrix[index, :len(item)] = item
+
+    numpy.savez(npzfile, kanji_ids=numpy.array(kanji_ids, dtype=numpy.int64), kanji=numpy.array(kanji),
+                counts=counts, features=matrix)
+
+    return len(kanji)
+
+
+class KanjiVGRecognizer:
+    def __init__(self, npzfile):
+        import numpy
+
+        self.numpy = numpy
+        data = numpy.load(npzfile)
+        self.kanji_ids = data["kanji_ids"]
+        self.kanji = data["kanji"]
+        self.counts = data["counts"]
+        self.features = data["features"]
+        data.close()
+
+    def distances(self, strokes):
+        numpy = self.numpy
+        drawn = numpy.array(strokes_features(strokes), dtype=numpy.float32).reshape(-1, stroke_features)
+
+        # Only the strokes present in both the input and the kanji are
+        # compared, the other ones are counted by the penalty
+        compared = min(len(drawn), self.features.shape[1])
+        differences = self.features[:, :compared] - drawn[:compared]
+        distances = numpy.einsum("ksf,ksf->ks", differences, differences)
+        distances *= numpy.arange(compared) < self.counts[:, None]
+
+        return distances.sum(axis=1) + missing_stroke_penalty * numpy.abs(self.counts - len(drawn))
+
+    def recognize(self, strokes, count=10):
+        numpy = self.numpy
+        distances = self.distances(strokes)
+
+        # Returns (kanji, distance) of the best candidates, nearest first
+        count = min(count, len(distances))
+        if count == 0:
+            return []
+        best = numpy.argpartition(distances, count - 1)[:count]
+        best = best[numpy.argsort(distances[best], kind="stable")]
+
+        return [(str(self.kanji[index]), float(distances[index])) for index in best]
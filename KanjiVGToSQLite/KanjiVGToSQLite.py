@@ -1,9 +1,15 @@
 
 from argparse import ArgumentParser, FileType, Action
 import xml.etree.ElementTree as ET
-import sqlite3
 import sys
 import os
+import shutil
+import importlib.util
+import re
+
+# Helpers shared by all the converters, see SQLiteImport.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "SQLiteImport"))
+from SQLiteImport import metrics, sqltrace, fast_build_pragmas, RowWriter, open_input, input_position, iter_root_children
 
 # For store the groups tree into database the nested set model
 # method has been used. Check this post for details:
@@ -28,18 +34,49 @@ radical_id_list = {
 		"tradit" : 2
 	}
 
+# Lookups done by a typical dictionary client, with --tracesql the query
+# plan of each one is checked for full table scans
+audit_queries = [
+    "SELECT rowid FROM {kanji} WHERE character = ?",
+    "SELECT rowid, lft, rgt FROM {groups} WHERE kanji_id = ?",
+    "SELECT rowid FROM {groups} WHERE lft > ? AND rgt < ?",
+    "SELECT path FROM {strokes} WHERE group_id = ?"
+    ]
+
+# With --encodepaths the path of every stroke is stored as a blob: a first
+# byte with the number of decimals kept, then every segment as its absolute
+# command letter followed by the coordinates quantized to those decimals and
+# written as zigzag varint deltas from the current point (the start point of
+# the segment). KanjiVGPaths.py decodes both forms
+path_commands = {"M": 2, "L": 2, "H": 1, "V": 1, "C": 6, "S": 4, "Q": 4, "T": 2, "Z": 0}
+path_token = re.compile(r"[A-Za-z]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+path_decimals = 2
+encode_paths = False
+
+# The rowid of kanji and groups is assigned while parsing, in this way
+# the rows of a whole kanji can be built before any of them is inserted
+id_tables = ("kanji", "groups")
+
 dbtable = dict()
+dbindex = list()
+dbfile = dict()
 
 def parse_cmdline():
     parser = ArgumentParser()
-    parser.add_argument("--kanjivgfile", help="path to the .xml KanjiVG file", default="kanjivg.xml")
+    parser.add_argument("--kanjivgfile", help="path to the .xml KanjiVG file (gzip, xz or bzip2 compressed files are accepted)", default="kanjivg.xml")
     parser.add_argument("--sqlitefile", help="path to the sqlite database to create", required=True)
     parser.add_argument("--dbtableprefix", help="prefix of db tables (ex. kanjivg)", default="kanjivg")
     parser.add_argument("--appendtables", help="append tables into an existing database file", action="store_true")
+    parser.add_argument("--fastbuild", "--fast-build", help="build the database with bulk load settings and create indexes at the end", action="store_true")
+    parser.add_argument("--encodepaths", "--encode-paths", help="store the stroke paths as compact binary blobs instead of svg path text", action="store_true")
+    parser.add_argument("--strokefeatures", "--stroke-features", help="also write the stroke features used by KanjiVGRecognizer.py to a .npz file next to the database (requires numpy)", action="store_true")
+    parser.add_argument("--batchsize", help="number of rows written to each table with a single statement", type=int, default=10000)
+    parser.add_argument("--metricsfile", help="write the import metrics (phase times, rows per table, peak memory) to this json file")
+    parser.add_argument("--tracesql", "--trace-sql", help="report the time spent by every sql statement and check the query plans of the common lookups", action="store_true")
     return parser.parse_args()
 
 
-def create_database(name, prefix, append):
+def create_database(name, prefix, append, fastbuild):
     sqlitefile = name
     global dbtable
 
@@ -53,17 +90,32 @@ def create_database(name, prefix, append):
     if len(sqlitefile) < 3 or sqlitefile[-3:] != ".db":
         sqlitefile = sqlitefile + ".db"
 
-    if append == False and os.path.exists(sqlitefile):
+    dbfile["name"] = sqlitefile
+    dbfile["fastbuild"] = fastbuild
+
+    if fastbuild:
+        # Database is built into a temporary file renamed only at the end
+        sqlitefile = sqlitefile + ".tmp"
+        if os.path.exists(sqlitefile):
+            os.remove(sqlitefile)
+        if append == True and os.path.exists(dbfile["name"]):
+            shutil.copyfile(dbfile["name"], sqlitefile)
+    elif append == False and os.path.exists(sqlitefile):
         os.remove(sqlitefile)
 
-    database = sqlite3.connect(sqlitefile)
+    dbfile["build"] = sqlitefile
+    database = sqltrace.connect(sqlitefile)
     c = database.cursor()
 
+    if fastbuild:
+        for pragma in fast_build_pragmas:
+            c.execute(pragma)
+
     table_name = dbtable["kanji"]
     c.execute("CREATE TABLE " + table_name + " ("
         "character TEXT"
         ")")
-    c.execute("CREATE INDEX " + table_name + "_character_index ON " + table_name + " (character)")
+    dbindex.append("CREATE INDEX " + table_name + "_character_index ON " + table_name + " (character)")
 
     table_name = dbtable["groups"]
     c.execute("CREATE TABLE " + table_name + " ("
@@ -82,122 +134,196 @@ def create_database(name, prefix, append):
         "tradForm INTEGER DEFAULT NULL,"
         "radicalForm INTEGER DEFAULT NULL"
         ")")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (kanji_id)")
-    c.execute("CREATE INDEX " + table_name + "_tree_index ON " + table_name + " (lft,rgt)")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (kanji_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_tree_index ON " + table_name + " (lft,rgt)")
 
     table_name = dbtable["strokes"]
     c.execute("CREATE TABLE " + table_name + " ("
         "group_id INTEGER,"
         "sequence INTEGER,"
         "type TEXT,"
-        "path TEXT"
+        "path " + ("BLOB" if encode_paths else "TEXT") +
         ")")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (group_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (group_id)")
+
+    if not fastbuild:
+        create_indexes(database)
 
     return database
 
 
-def parse_path(path, group_id, database):
+def create_indexes(database):
     c = database.cursor()
 
+    with metrics.phase("index"):
+        for query in dbindex:
+            c.execute(query)
+
+    dbindex.clear()
+
+
+def close_database(database):
+    # In fast build mode tables are filled without indexes, all of them
+    # are created in a single pass once the data has been imported
+    if dbfile["fastbuild"]:
+        create_indexes(database)
+
+    with metrics.phase("commit"):
+        database.commit()
+    database.close()
+
+    if dbfile["fastbuild"]:
+        os.replace(dbfile["build"], dbfile["name"])
+
+
+def bool_attribute(value):
+    if value == None:
+        return None
+    if value == "true":
+        return 1
+    return 0
+
+
+def write_varint(data, value):
+    value = value * 2 if value >= 0 else -value * 2 - 1
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+
+
+def encode_path(d):
+    scale = 10 ** path_decimals
+    tokens = path_token.findall(d)
+    data = bytearray([path_decimals])
+    # Current and subpath start points, as float and quantized
+    x = y = start_x = start_y = 0.0
+    qx = qy = start_qx = start_qy = 0
+    command = None
+    index = 0
+
+    # Returns None if the path uses commands not handled (arcs)
+    while index < len(tokens):
+        if tokens[index].isalpha():
+            command = tokens[index]
+            index += 1
+        if command == None or command.upper() not in path_commands:
+            return None
+        upper = command.upper()
+
+        if upper == "Z":
+            data.append(ord("Z"))
+            x, y, qx, qy = start_x, start_y, start_qx, start_qy
+            command = None
+            continue
+
+        count = path_commands[upper]
+        values = tokens[index:index + count]
+        if len(values) != count or any(value.isalpha() for value in values):
+            return None
+        index += count
+
+        data.append(ord(upper))
+        for number, value in enumerate(values):
+            # H has only x, V only y, the other commands alternate x and y
+            horizontal = upper == "H" or (upper != "V" and number % 2 == 0)
+            value = float(value)
+            if horizontal:
+                if command.islower():
+                    value += x
+                q = round(value * scale)
+                write_varint(data, q - qx)
+                last_x, last_qx = value, q
+            else:
+                if command.islower():
+                    value += y
+                q = round(value * scale)
+                write_varint(data, q - qy)
+                last_y, last_qy = value, q
+        if upper != "V":
+            x, qx = last_x, last_qx
+        if upper != "H":
+            y, qy = last_y, last_qy
+
+        if upper == "M":
+            start_x, start_y, start_qx, start_qy = x, y, qx, qy
+            # Coordinates following a moveto are implicit lineto
+            command = "l" if command == "m" else "L"
+
+    return bytes(data)
+
+
+def parse_path(path, group_id):
     id = path.attrib.get("id")
     type = path.attrib.get(kvg+"type")
     d = path.attrib.get("d")
 
     sequence = int(id[11:])
 
-    c.execute("INSERT INTO " + dbtable["strokes"] + " (group_id, sequence, type, path) VALUES (?,?,?,?)", [group_id, sequence, type, d])
+    if encode_paths and d != None:
+        data = encode_path(d)
+        if data != None:
+            d = data
 
+    return (group_id, sequence, type, d)
 
-def parse_group(group, kanji_id, parent_lft, database):
-    table_name = dbtable["groups"]
-    c = database.cursor()
+
+def parse_group(group, kanji_id, groups, strokes, writer):
+    group_id = writer.new_id("groups")
 
     id = group.attrib.get("id")
-    element = group.attrib.get(kvg+"element")
-    original = group.attrib.get(kvg+"original")
     position = group.attrib.get(kvg+"position")
-    variant = group.attrib.get(kvg+"variant")
-    partial = group.attrib.get(kvg+"partial")
-    number = group.attrib.get(kvg+"number")
     radical = group.attrib.get(kvg+"radical")
-    phon = group.attrib.get(kvg+"phon")
-    tradForm = group.attrib.get(kvg+"tradForm")
-    radicalForm = group.attrib.get(kvg+"radicalForm")
 
     sequence = 0
     if id.find("-g") != -1:
         sequence = int(id[11:])
 
-    if parent_lft > 0:
-        c.execute("UPDATE " + table_name + " SET lft = lft + 2 WHERE kanji_id = ? AND lft > ?", [kanji_id, parent_lft])
-        c.execute("UPDATE " + table_name + " SET rgt = rgt + 2 WHERE kanji_id = ? AND rgt > ?", [kanji_id, parent_lft])
-   
-    lft = parent_lft + 1
-    rgt = parent_lft + 2
-
-    query = "INSERT INTO " + table_name + " (kanji_id, lft, rgt, sequence"
-    values = [kanji_id, lft, rgt, sequence]
-
-    if element != None:
-        values.append(element)
-        query += ", element"
-    if original != None:
-        values.append(original)
-        query += ", original"
     if position != None:
-        values.append(position_id_list[position])
-        query += ", position"
-    if variant != None:
-        if variant == "true":
-            values.append(1)
-        else:
-            values.append(0)
-        query += ", variant"
-    if partial != None:
-        if partial == "true":
-            values.append(1)
-        else:
-            values.append(0)
-        query += ", partial"
-    if number != None:
-        values.append(number)
-        query += ", number"
+        position = position_id_list[position]
     if radical != None:
-        values.append(radical_id_list[radical])
-        query += ", radical"
-    if phon != None:
-        values.append(phon)
-        query += ", phon"
-    if tradForm != None:
-        if tradForm == "true":
-            values.append(1)
-        else:
-            values.append(0)
-        query += ", tradForm"
-    if radicalForm != None:
-        if radicalForm == "true":
-            values.append(1)
-        else:
-            values.append(0)
-        query += ", radicalForm"
-
-    query += ") VALUES (?,?,?,?"
-    for i in range(0, len(values)-4):
-        query += ",?"
-    query += ")"
-    
-    c.execute(query, values)
-    group_id = c.lastrowid
+        radical = radical_id_list[radical]
+
+    # lft and rgt are set by number_groups once the whole tree is known
+    row = [group_id, kanji_id, 0, 0, sequence,
+           group.attrib.get(kvg+"element"),
+           group.attrib.get(kvg+"original"),
+           position,
+           bool_attribute(group.attrib.get(kvg+"variant")),
+           bool_attribute(group.attrib.get(kvg+"partial")),
+           group.attrib.get(kvg+"number"),
+           radical,
+           group.attrib.get(kvg+"phon"),
+           bool_attribute(group.attrib.get(kvg+"tradForm")),
+           bool_attribute(group.attrib.get(kvg+"radicalForm"))]
+    groups.append(row)
+    children = []
 
     for item in group:
         if item.tag == "g":
-            parse_group(item, kanji_id, lft, database)
+            children.append(parse_group(item, kanji_id, groups, strokes, writer))
         elif item.tag == "path":
-            parse_path(item, group_id, database)
+            strokes.append(parse_path(item, group_id))
+
+    return (row, children)
+
+
+def number_groups(node, lft):
+    row, children = node
+
+    # Nested set numbers assigned with a single depth first visit, children
+    # are numbered starting from the last one since in the stored trees every
+    # group comes before its previous siblings. Returns the next free number
+    row[2] = lft
+    rgt = lft + 1
+    for child in reversed(children):
+        rgt = number_groups(child, rgt)
+    row[3] = rgt
+
+    return rgt + 1
 
 
-def parse_kanji(kanji, database):
+def parse_kanji(kanji, writer):
     kanji_code = kanji.attrib.get("id")
     
     if kanji_code == None or len(kanji_code) != 15 or kanji_code[0:10] != "kvg:kanji_":
@@ -207,50 +333,91 @@ def parse_kanji(kanji, database):
     kanji_code = int(kanji_code[10:15], 16)
 
     if kanji_code >= 0x4E00 and kanji_code <= 0x9FBF: # Only kanji are stored into database
-        c = database.cursor()
-        c.execute("INSERT INTO " + dbtable["kanji"] + " (character) VALUES (?)", chr(kanji_code))
-        kanji_id = c.lastrowid
+        kanji_id = writer.new_id("kanji")
+        writer.add("kanji", (kanji_id, chr(kanji_code)))
     
         if len(kanji) != 1 or kanji[0].tag != "g":
             print("Invalid kanji format")
             return
 
-        parse_group(kanji[0], kanji_id, 0, database)
+        groups = []
+        strokes = []
+        number_groups(parse_group(kanji[0], kanji_id, groups, strokes, writer), 1)
 
+        for row in groups:
+            writer.add("groups", row)
+        for row in strokes:
+            writer.add("strokes", row)
 
-def parse_kanjisv(file, database):
-    tree = ET.parse(file)
-    root = tree.getroot()
+
+def parse_kanjisv(file, database, batch_size):
+    writer = RowWriter(database, dbtable, id_tables, batch_size)
+    xml_file = open_input(file)
+    context = ET.iterparse(xml_file, events=("start", "end"))
+    event, root = next(context)
     counter = 0
 
     if root.tag != "kanjivg":
         print("Invalid kanjivg file")
+        xml_file.close()
+        return
+
+    metrics.set_input(xml_file)
+    with metrics.phase("parse"):
+        for item in iter_root_children(context, root):
+            if item.tag == "kanji":
+                parse_kanji(item, writer)
+                writer.flush_full()
+                counter += 1
+                if not counter % 100:
+                    metrics.progress(counter, input_position(xml_file))
+        writer.flush()
+
+    metrics.progress(counter, input_position(xml_file), True)
+    xml_file.close()
+    with metrics.phase("commit"):
+        database.commit()
+
+
+def create_stroke_features(prefix):
+    # The features are computed by KanjiVGRecognizer.py, in this way the
+    # stored ones and the drawn input are always processed the same way
+    if importlib.util.find_spec("numpy") == None:
+        print("Stroke features not created, numpy is not installed")
         return
 
-    for item in root:
-        if item.tag == "kanji":
-            parse_kanji(item, database)
-            counter += 1
-            if not counter % 100:
-                print("#", end="", flush=True)
+    from KanjiVGRecognizer import build_features
 
-    database.commit()
+    npzfile = dbfile["name"][:-3] + "_strokes.npz"
+    print("Create stroke features...", end="\n", flush=True)
+    with metrics.phase("features"):
+        build_features(dbfile["name"], npzfile, prefix)
 
 
 def main():
+    global encode_paths
     args = parse_cmdline()
+    sqltrace.enabled = args.tracesql
+    encode_paths = args.encodepaths
     appendtables = False
 
     if args.appendtables:
         appendtables = True
 
     print("Create database...", end="\n", flush=True)
-    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables)
-
-    print("Start importing KanjiVG data:", end="", flush=True)
-    parse_kanjisv(args.kanjivgfile, database)
-
-    database.close()
+    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables, args.fastbuild)
+
+    print("Start importing KanjiVG data:", end="\n", flush=True)
+    parse_kanjisv(args.kanjivgfile, database, args.batchsize)
+
+    metrics.count_rows(database, dbtable.values())
+    close_database(database)
+    if args.strokefeatures:
+        create_stroke_features(args.dbtableprefix.strip())
+    metrics.report(args.metricsfile)
+    if args.tracesql:
+        sqltrace.report()
+        sqltrace.audit(dbfile["name"], audit_queries, dbtable)
 
     
 if __name__ == '__main__':
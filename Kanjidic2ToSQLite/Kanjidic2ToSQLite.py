@@ -1,22 +1,96 @@
 
 from argparse import ArgumentParser, FileType, Action
 import xml.etree.ElementTree as ET
-import sqlite3
 import sys
 import os
+import shutil
+
+# Helpers shared by all the converters, see SQLiteImport.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "SQLiteImport"))
+from SQLiteImport import metrics, sqltrace, fast_build_pragmas, RowWriter, open_input, input_position, iter_root_children
+
+# Lookups done by a typical dictionary client, with --tracesql the query
+# plan of each one is checked for full table scans
+audit_queries = [
+    "SELECT rowid FROM {kanji} WHERE literal = ?",
+    "SELECT type, text FROM {reading} WHERE kanji_id = ?",
+    "SELECT text FROM {meaning} WHERE kanji_id = ?",
+    "SELECT text FROM {nanori} WHERE kanji_id = ?",
+    "SELECT kanji_id FROM {reading} WHERE text = ?",
+    "SELECT kanji_id FROM {meaning} WHERE text = ?",
+    "SELECT literal FROM {kanji} WHERE jlpt = ? ORDER BY freq",
+    "SELECT literal FROM {kanji} WHERE grade = ? ORDER BY freq",
+    "SELECT literal FROM {kanji} WHERE freq <= ? ORDER BY freq",
+    "SELECT literal FROM {kanji} WHERE q_code_skip_pattern = ? AND q_code_skip_count1 = ?",
+    "SELECT literal FROM {kanji} WHERE q_code_four_corner_number BETWEEN ? AND ?",
+    "SELECT literal FROM {kanji} WHERE q_code_deroo_top = ?"
+    ]
+
+# Columns of the kanji table (in the same order) with their default value,
+# used to build the kanji rows
+kanji_columns = [
+    ("literal", ""),
+    ("codepoint_jis208", ""),
+    ("codepoint_jis212", ""),
+    ("codepoint_jis213", ""),
+    ("codepoint_ucs", ""),
+    ("radical_classical", ""),
+    ("radical_nelson_c", ""),
+    ("grade", None),
+    ("stroke_count", 0),
+    ("variant_jis208", ""),
+    ("variant_jis212", ""),
+    ("variant_jis213", ""),
+    ("variant_deroo", ""),
+    ("variant_njecd", ""),
+    ("variant_s_h", ""),
+    ("variant_nelson_c", ""),
+    ("variant_oneill", ""),
+    ("variant_ucs", ""),
+    ("freq", None),
+    ("rad_name", ""),
+    ("jlpt", None),
+    ("q_code_skip", ""),
+    ("q_code_skip_misclass", ""),
+    ("q_code_sh_desc", ""),
+    ("q_code_four_corner", ""),
+    ("q_code_deroo", ""),
+    ("q_code_skip_pattern", None),
+    ("q_code_skip_count1", None),
+    ("q_code_skip_count2", None),
+    ("q_code_four_corner_number", None),
+    ("q_code_four_corner_extra", None),
+    ("q_code_deroo_top", None),
+    ("q_code_deroo_bottom", None)
+    ]
+
+# Languages of the meanings to import (ISO 639-1 codes as in the m_lang
+# attribute, "en" if missing), empty to import all of them
+meaning_languages = set()
+
+# The kanji rowid is assigned while parsing, in this way the reading,
+# meaning and nanori rows can be built before the kanji row is inserted
+id_tables = ("kanji",)
 
 dbtable = dict()
+dbindex = list()
+dbfile = dict()
 
 def parse_cmdline():
     parser = ArgumentParser()
-    parser.add_argument("--kanjidic2file", help="path to the .xml Kanjidic2 file", default="kanjidic2.xml")
+    parser.add_argument("--kanjidic2file", help="path to the .xml Kanjidic2 file (gzip, xz or bzip2 compressed files are accepted)", default="kanjidic2.xml")
     parser.add_argument("--sqlitefile", help="path to the sqlite database to create", required=True)
     parser.add_argument("--dbtableprefix", help="prefix of db tables (ex. kanjidict)", default="kanjidict")
     parser.add_argument("--appendtables", help="append tables into an existing database file", action="store_true")
+    parser.add_argument("--fastbuild", "--fast-build", help="build the database with bulk load settings and create indexes at the end", action="store_true")
+    parser.add_argument("--languages", help="comma separated list of the meaning languages to import (ex. en,fr), all to import every language", default="en")
+    parser.add_argument("--batchsize", help="number of rows written to each table with a single statement", type=int, default=10000)
+    parser.add_argument("--metricsfile", help="write the import metrics (phase times, rows per table, peak memory) to this json file")
+    parser.add_argument("--tracesql", "--trace-sql", help="report the time spent by every sql statement and check the query plans of the common lookups", action="store_true")
     return parser.parse_args()
 
 
-def create_database(name, prefix, append):
+def create_database(name, prefix, append, fastbuild):
     sqlitefile = name
     global dbtable
 
@@ -31,12 +105,27 @@ def create_database(name, prefix, append):
     if len(sqlitefile) < 3 or sqlitefile[-3:] != ".db":
         sqlitefile = sqlitefile + ".db"
 
-    if append == False and os.path.exists(sqlitefile):
+    dbfile["name"] = sqlitefile
+    dbfile["fastbuild"] = fastbuild
+
+    if fastbuild:
+        # Database is built into a temporary file renamed only at the end
+        sqlitefile = sqlitefile + ".tmp"
+        if os.path.exists(sqlitefile):
+            os.remove(sqlitefile)
+        if append == True and os.path.exists(dbfile["name"]):
+            shutil.copyfile(dbfile["name"], sqlitefile)
+    elif append == False and os.path.exists(sqlitefile):
         os.remove(sqlitefile)
 
-    database = sqlite3.connect(sqlitefile)
+    dbfile["build"] = sqlitefile
+    database = sqltrace.connect(sqlitefile)
     c = database.cursor()
 
+    if fastbuild:
+        for pragma in fast_build_pragmas:
+            c.execute(pragma)
+
     table_name = dbtable["kanji"]
     c.execute("CREATE TABLE " + table_name + " ("
 	    "literal TEXT DEFAULT '',"
@@ -46,7 +135,7 @@ def create_database(name, prefix, append):
 	    "codepoint_ucs TEXT DEFAULT '',"
 	    "radical_classical TEXT DEFAULT '',"
 	    "radical_nelson_c TEXT DEFAULT '',"
-	    "grade INTEGER DEFAULT 0,"
+	    "grade INTEGER,"
 	    "stroke_count INTEGER DEFAULT 0,"
 	    "variant_jis208 TEXT DEFAULT '',"
 	    "variant_jis212 TEXT DEFAULT '',"
@@ -57,16 +146,33 @@ def create_database(name, prefix, append):
 	    "variant_nelson_c TEXT DEFAULT '',"
 	    "variant_oneill TEXT DEFAULT '',"
 	    "variant_ucs TEXT DEFAULT '',"
-	    "freq INTEGER DEFAULT 0,"
+	    "freq INTEGER,"
 	    "rad_name TEXT DEFAULT '',"
-	    "jlpt INTEGER DEFAULT 0,"
+	    "jlpt INTEGER,"
 	    "q_code_skip TEXT DEFAULT '',"
         "q_code_skip_misclass TEXT DEFAULT '',"
 	    "q_code_sh_desc TEXT DEFAULT '',"
 	    "q_code_four_corner TEXT DEFAULT '',"
-	    "q_code_deroo TEXT DEFAULT ''"
+	    "q_code_deroo TEXT DEFAULT '',"
+	    "q_code_skip_pattern INTEGER,"
+	    "q_code_skip_count1 INTEGER,"
+	    "q_code_skip_count2 INTEGER,"
+	    "q_code_four_corner_number INTEGER,"
+	    "q_code_four_corner_extra INTEGER,"
+	    "q_code_deroo_top INTEGER,"
+	    "q_code_deroo_bottom INTEGER"
 	    ")")
-    c.execute("CREATE INDEX " + table_name + "_literal_index ON " + table_name + " (literal)")
+    dbindex.append("CREATE INDEX " + table_name + "_literal_index ON " + table_name + " (literal)")
+    # Indexes for the study list filters, grade, jlpt and freq are NULL if
+    # the kanji doesn't have them so the partial indexes skip those rows. The
+    # freq column is part of the key, lists filtered by grade or jlpt come
+    # already ordered by frequency
+    dbindex.append("CREATE INDEX " + table_name + "_jlpt_index ON " + table_name + " (jlpt, freq) WHERE jlpt IS NOT NULL")
+    dbindex.append("CREATE INDEX " + table_name + "_grade_index ON " + table_name + " (grade, freq) WHERE grade IS NOT NULL")
+    dbindex.append("CREATE INDEX " + table_name + "_freq_index ON " + table_name + " (freq) WHERE freq IS NOT NULL")
+    dbindex.append("CREATE INDEX " + table_name + "_skip_index ON " + table_name + " (q_code_skip_pattern, q_code_skip_count1, q_code_skip_count2) WHERE q_code_skip_pattern IS NOT NULL")
+    dbindex.append("CREATE INDEX " + table_name + "_four_corner_index ON " + table_name + " (q_code_four_corner_number, q_code_four_corner_extra) WHERE q_code_four_corner_number IS NOT NULL")
+    dbindex.append("CREATE INDEX " + table_name + "_deroo_index ON " + table_name + " (q_code_deroo_top, q_code_deroo_bottom) WHERE q_code_deroo_top IS NOT NULL")
 
     table_name = dbtable["reading"]
     c.execute("CREATE TABLE " + table_name + " ("
@@ -74,186 +180,237 @@ def create_database(name, prefix, append):
 		"type TEXT,"
 		"text TEXT"
 		")")
-    c.execute("CREATE INDEX " + table_name + "_kanji_id_index ON " + table_name + " (kanji_id)")
-    c.execute("CREATE INDEX " + table_name + "_text_index ON " + table_name + " (text)")
+    dbindex.append("CREATE INDEX " + table_name + "_kanji_id_index ON " + table_name + " (kanji_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_text_index ON " + table_name + " (text)")
 
     table_name = dbtable["meaning"]
     c.execute("CREATE TABLE " + table_name + " ("
 		"kanji_id INTEGER,"
-		"text TEXT"
+		"text TEXT,"
+		"lang TEXT DEFAULT 'en'"
 		")")
-    c.execute("CREATE INDEX " + table_name + "_kanji_id_index ON " + table_name + " (kanji_id)")
-    c.execute("CREATE INDEX " + table_name + "_text_index ON " + table_name + " (text)")
+    dbindex.append("CREATE INDEX " + table_name + "_kanji_id_index ON " + table_name + " (kanji_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_text_index ON " + table_name + " (text)")
 
     table_name = dbtable["nanori"]
     c.execute("CREATE TABLE " + table_name + " ("
 		"kanji_id INTEGER,"
 		"text TEXT"
 		")")
-    c.execute("CREATE INDEX " + table_name + "_kanji_id_index ON " + table_name + " (kanji_id)")
-    c.execute("CREATE INDEX " + table_name + "_text_index ON " + table_name + " (text)")
+    dbindex.append("CREATE INDEX " + table_name + "_kanji_id_index ON " + table_name + " (kanji_id)")
+    dbindex.append("CREATE INDEX " + table_name + "_text_index ON " + table_name + " (text)")
+
+    if not fastbuild:
+        create_indexes(database)
 
     return database
 
 
-def parse_codepoint(codepoint, kanji_id, database):
+def create_indexes(database):
     c = database.cursor()
 
+    with metrics.phase("index"):
+        for query in dbindex:
+            c.execute(query)
+
+    dbindex.clear()
+
+
+def close_database(database):
+    # In fast build mode tables are filled without indexes, all of them
+    # are created in a single pass once the data has been imported
+    if dbfile["fastbuild"]:
+        create_indexes(database)
+
+    with metrics.phase("commit"):
+        database.commit()
+    database.close()
+
+    if dbfile["fastbuild"]:
+        os.replace(dbfile["build"], dbfile["name"])
+
+
+def parse_codepoint(codepoint, kanji):
     for item in codepoint:
         if item.tag == "cp_value":
             code = item.attrib.get("cp_type")
-            if code == "jis208":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET codepoint_jis208 = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif code == "jis212":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET codepoint_jis212 = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif code == "jis213":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET codepoint_jis213 = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif code == "ucs":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET codepoint_ucs = ? WHERE rowid = ?", (item.text, kanji_id))
+            if code in ("jis208", "jis212", "jis213", "ucs"):
+                kanji["codepoint_" + code] = item.text
 
 
-def parse_radical(radical, kanji_id, database):
-    c = database.cursor()
-
+def parse_radical(radical, kanji):
     for item in radical:
         if item.tag == "rad_value":
             type = item.attrib.get("rad_type")
-            if type == "classical":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET radical_classical = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "nelson_c":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET radical_nelson_c = ? WHERE rowid = ?", (item.text, kanji_id))
+            if type in ("classical", "nelson_c"):
+                kanji["radical_" + type] = item.text
 
 
-def parse_query_code(query_code, kanji_id, database):
-    c = database.cursor()
+def parse_query_code(query_code, kanji):
+    skip_misclass = []
 
     for item in query_code:
-        if item.tag == "query_code":
+        if item.tag == "q_code":
             type = item.attrib.get("qc_type")
             if type == "skip":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET q_code_skip = ?, q_code_skip_misclass = ? WHERE rowid = ?", (item.text, item.attrib.get("skip_misclass", ""), kanji_id))
-            elif type == "sh_desc":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET q_code_sh_desc = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "four_corner":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET q_code_four_corner = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "deroo":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET q_code_deroo = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "misclass":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET q_code_misclass = ? WHERE rowid = ?", (item.text, kanji_id))
-
-
-def parse_misc(misc, kanji_id, database):
-    c = database.cursor()
-
+                # Codes marked with skip_misclass are the wrong codes the
+                # kanji could be looked up with, kept as "kind:code"
+                misclass = item.attrib.get("skip_misclass")
+                if misclass == None:
+                    kanji["q_code_skip"] = item.text
+                else:
+                    skip_misclass.append(misclass + ":" + item.text)
+            elif type in ("sh_desc", "four_corner", "deroo"):
+                kanji["q_code_" + type] = item.text
+
+    if len(skip_misclass) > 0:
+        kanji["q_code_skip_misclass"] = " ".join(skip_misclass)
+
+    split_query_codes(kanji)
+
+
+def split_query_codes(kanji):
+    # Numeric parts of the codes stored in their own columns for the filter
+    # indexes, codes not in the expected format leave them NULL. SKIP is
+    # pattern-count1-count2 (ex. 1-4-3), four corner is the four digits
+    # number with the optional fifth digit (ex. 7496.1) and De Roo is the top
+    # part followed by the two digits of the bottom part (ex. 3273)
+    try:
+        pattern, count1, count2 = kanji["q_code_skip"].split("-")
+        kanji["q_code_skip_pattern"] = int(pattern)
+        kanji["q_code_skip_count1"] = int(count1)
+        kanji["q_code_skip_count2"] = int(count2)
+    except (KeyError, ValueError):
+        pass
+
+    try:
+        code = kanji["q_code_four_corner"].split(".")
+        kanji["q_code_four_corner_number"] = int(code[0])
+        if len(code) > 1:
+            kanji["q_code_four_corner_extra"] = int(code[1])
+    except (KeyError, ValueError):
+        pass
+
+    try:
+        code = kanji["q_code_deroo"]
+        if len(code) >= 3:
+            kanji["q_code_deroo_top"] = int(code[:-2])
+            kanji["q_code_deroo_bottom"] = int(code[-2:])
+    except (KeyError, ValueError):
+        pass
+
+
+def parse_misc(misc, kanji):
     for item in misc:
-        if item.tag == "grade":
-            c.execute("UPDATE " + dbtable["kanji"] + " SET grade = ? WHERE rowid = ?", (item.text, kanji_id))
+        if item.tag in ("grade", "freq", "jlpt"):
+            kanji[item.tag] = int(item.text)
+        elif item.tag == "rad_name":
+            kanji[item.tag] = item.text
         elif item.tag == "stroke_count":
-            c.execute("UPDATE " + dbtable["kanji"] + " SET stroke_count = ? WHERE rowid = ?", (item.text, kanji_id))
+            # The first one is the accepted count, the others are common
+            # miscounts
+            kanji.setdefault("stroke_count", int(item.text))
         elif item.tag == "variant":
             type = item.attrib.get("var_type")
-            if type == "jis208":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET variant_jis208 = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "jis212":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET variant_jis212 = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "jis213":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET variant_jis213 = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "deroo":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET variant_deroo = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "njecd":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET variant_njecd = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "s_h":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET variant_s_h = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "nelson_c":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET variant_nelson_c = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "oneill":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET variant_oneill = ? WHERE rowid = ?", (item.text, kanji_id))
-            elif type == "ucs":
-                c.execute("UPDATE " + dbtable["kanji"] + " SET variant_ucs = ? WHERE rowid = ?", (item.text, kanji_id))
-        elif item.tag == "freq":
-            c.execute("UPDATE " + dbtable["kanji"] + " SET freq = ? WHERE rowid = ?", (item.text, kanji_id))
-        elif item.tag == "rad_name":
-            c.execute("UPDATE " + dbtable["kanji"] + " SET rad_name = ? WHERE rowid = ?", (item.text, kanji_id))
-        elif item.tag == "jlpt":
-            c.execute("UPDATE " + dbtable["kanji"] + " SET jlpt = ? WHERE rowid = ?", (item.text, kanji_id))
-        elif item.tag == "query_code":
-            parse_query_code(item, kanji_id, database)
-
+            if type in ("jis208", "jis212", "jis213", "deroo", "njecd", "s_h", "nelson_c", "oneill", "ucs"):
+                kanji["variant_" + type] = item.text
 
-def parse_rmgroup(rmgroup, kanji_id, database):
-    c = database.cursor()
 
+def parse_rmgroup(rmgroup, kanji_id, writer):
     for item in rmgroup:
         if item.tag == "reading":
             type = item.attrib.get("r_type")
             if type == "ja_on" or type == "ja_kun":
-                c.execute("INSERT INTO " + dbtable["reading"] + " (kanji_id, type, text) VALUES (?,?,?)", (kanji_id, type, item.text))
+                writer.add("reading", (kanji_id, type, item.text))
         elif item.tag == "meaning":
-            if(item.attrib.get("m_lang") == None):
-                c.execute("INSERT INTO " + dbtable["meaning"] + " (kanji_id, text) VALUES (?,?)", (kanji_id, item.text))
+            lang = item.attrib.get("m_lang", "en")
+            if len(meaning_languages) == 0 or lang in meaning_languages:
+                writer.add("meaning", (kanji_id, item.text, lang))
 
 
-def parse_reading_meaning(reading_meaning, kanji_id, database):
-    c = database.cursor()
-
+def parse_reading_meaning(reading_meaning, kanji_id, writer):
     for item in reading_meaning:
         if item.tag == "rmgroup":
-            parse_rmgroup(item, kanji_id, database)
+            parse_rmgroup(item, kanji_id, writer)
         elif item.tag == "nanori":
-            c.execute("INSERT INTO " + dbtable["nanori"] + " (kanji_id, text) VALUES (?,?)", (kanji_id, item.text))
+            writer.add("nanori", (kanji_id, item.text))
 
 
-def parse_character(character, database):
-    c = database.cursor()
-    c.execute("INSERT INTO " + dbtable["kanji"] + " DEFAULT VALUES")
-    kanji_id = c.lastrowid
+def parse_character(character, writer):
+    kanji_id = writer.new_id("kanji")
+    kanji = dict()
 
+    # All the fields of the character are collected first and then written
+    # with a single kanji row
     for item in character:
         if item.tag == "literal":
-            c.execute("UPDATE " + dbtable["kanji"] + " SET literal = ? WHERE rowid = ?", (item.text, kanji_id))
+            kanji["literal"] = item.text
         elif item.tag == "codepoint":
-            parse_codepoint(item, kanji_id, database)
+            parse_codepoint(item, kanji)
         elif item.tag == "radical":
-            parse_radical(item, kanji_id, database)
+            parse_radical(item, kanji)
         elif item.tag == "misc":
-            parse_misc(item, kanji_id, database)
+            parse_misc(item, kanji)
+        elif item.tag == "query_code":
+            parse_query_code(item, kanji)
         elif item.tag == "reading_meaning":
-            parse_reading_meaning(item, kanji_id, database)
+            parse_reading_meaning(item, kanji_id, writer)
 
+    writer.add("kanji", [kanji_id] + [kanji.get(name, default) for name, default in kanji_columns])
 
-def parse_kanjidic2(file, database):
-    tree = ET.parse(file)
-    root = tree.getroot()
+
+def parse_kanjidic2(file, database, batch_size):
+    writer = RowWriter(database, dbtable, id_tables, batch_size)
+    xml_file = open_input(file)
+    context = ET.iterparse(xml_file, events=("start", "end"))
+    event, root = next(context)
     counter = 0
 
     if root.tag != "kanjidic2":
         print("Invalid kanjidic2 file")
+        xml_file.close()
         return
 
-    for item in root:
-        if item.tag == "character":
-            parse_character(item, database)
-            counter += 1
-            if not counter % 100:
-                print("#", end="", flush=True)
+    metrics.set_input(xml_file)
+    with metrics.phase("parse"):
+        for item in iter_root_children(context, root):
+            if item.tag == "character":
+                parse_character(item, writer)
+                writer.flush_full()
+                counter += 1
+                if not counter % 100:
+                    metrics.progress(counter, input_position(xml_file))
+        writer.flush()
 
-    database.commit()
+    metrics.progress(counter, input_position(xml_file), True)
+    xml_file.close()
+    with metrics.phase("commit"):
+        database.commit()
 
 
 def main():
     args = parse_cmdline()
+    sqltrace.enabled = args.tracesql
     appendtables = False
 
     if args.appendtables:
         appendtables = True
 
+    if args.languages != "all":
+        meaning_languages.update(lang.strip() for lang in args.languages.split(",") if lang.strip() != "")
+
     print("Create database...", end="\n", flush=True)
-    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables)
+    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables, args.fastbuild)
 
-    print("Start importing Kanjidic2 data:", end="", flush=True)
-    parse_kanjidic2(args.kanjidic2file, database)
+    print("Start importing Kanjidic2 data:", end="\n", flush=True)
+    parse_kanjidic2(args.kanjidic2file, database, args.batchsize)
 
-    database.close()
+    metrics.count_rows(database, dbtable.values())
+    close_database(database)
+    metrics.report(args.metricsfile)
+    if args.tracesql:
+        sqltrace.report()
+        sqltrace.audit(dbfile["name"], audit_queries, dbtable)
 
     
 if __name__ == '__main__':
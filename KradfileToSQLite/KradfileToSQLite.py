@@ -1,23 +1,46 @@
 
 from argparse import ArgumentParser, FileType, Action
-import sqlite3
 import sys
-import codecs
 import os
+import shutil
+
+# Helpers shared by all the converters, see SQLiteImport.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "SQLiteImport"))
+from SQLiteImport import metrics, sqltrace, fast_build_pragmas, open_input, input_position
+
+# Lookups done by a typical dictionary client, with --tracesql the query
+# plan of each one is checked for full table scans
+audit_queries = [
+    "SELECT rowid FROM {radicals} WHERE data = ?",
+    "SELECT rowid FROM {kanji} WHERE data = ?",
+    "SELECT radical_id FROM {kanji_radical} WHERE kanji_id = ?",
+    "SELECT kanji_id FROM {kanji_radical} WHERE radical_id = ?"
+    ]
 
 dbtable = dict()
+dbindex = list()
+dbfile = dict()
+
+# Ids of the radicals and kanji already seen and rows waiting to be inserted,
+# ids are assigned here since the tables are always created empty
+radical_ids = dict()
+kanji_ids = dict()
+dbrows = dict(radicals=[], kanji=[], kanji_radical=set())
 
 def parse_cmdline():
     parser = ArgumentParser()
-    parser.add_argument("--kradfile", help="path to the kradfile", default="kradfile")
-    parser.add_argument("--kradfile2", help="path to the kradfile2", default="kradfile2")
+    parser.add_argument("--kradfile", help="path to the kradfile (gzip, xz or bzip2 compressed files are accepted)", default="kradfile")
+    parser.add_argument("--kradfile2", help="path to the kradfile2 (gzip, xz or bzip2 compressed files are accepted)", default="kradfile2")
     parser.add_argument("--sqlitefile", help="path to the sqlite database to create", required=True)
     parser.add_argument("--dbtableprefix", help="prefix of db tables (ex. krad)", default="krad")
     parser.add_argument("--appendtables", help="append tables into an existing database file", action="store_true")
+    parser.add_argument("--fastbuild", "--fast-build", help="build the database with bulk load settings and create indexes at the end", action="store_true")
+    parser.add_argument("--metricsfile", help="write the import metrics (phase times, rows per table, peak memory) to this json file")
+    parser.add_argument("--tracesql", "--trace-sql", help="report the time spent by every sql statement and check the query plans of the common lookups", action="store_true")
     return parser.parse_args()
 
 
-def create_database(name, prefix, append):
+def create_database(name, prefix, append, fastbuild):
     sqlitefile = name
     global dbtable
 
@@ -31,75 +54,144 @@ def create_database(name, prefix, append):
     if len(sqlitefile) < 3 or sqlitefile[-3:] != ".db":
         sqlitefile = sqlitefile + ".db"
 
-    if append == False and os.path.exists(sqlitefile):
+    dbfile["name"] = sqlitefile
+    dbfile["fastbuild"] = fastbuild
+
+    if fastbuild:
+        # Database is built into a temporary file renamed only at the end
+        sqlitefile = sqlitefile + ".tmp"
+        if os.path.exists(sqlitefile):
+            os.remove(sqlitefile)
+        if append == True and os.path.exists(dbfile["name"]):
+            shutil.copyfile(dbfile["name"], sqlitefile)
+    elif append == False and os.path.exists(sqlitefile):
         os.remove(sqlitefile)
 
-    database = sqlite3.connect(sqlitefile)
+    dbfile["build"] = sqlitefile
+    database = sqltrace.connect(sqlitefile)
     c = database.cursor()
 
+    if fastbuild:
+        for pragma in fast_build_pragmas:
+            c.execute(pragma)
+
     table_name = dbtable["radicals"]
     c.execute("CREATE TABLE " + table_name + " (data TEXT NOT NULL)")
-    c.execute("CREATE INDEX " + table_name + "_data_index ON " + table_name + " (data)")
+    dbindex.append("CREATE INDEX " + table_name + "_data_index ON " + table_name + " (data)")
 
     table_name = dbtable["kanji"]
     c.execute("CREATE TABLE " + table_name + " (data TEXT NOT NULL)")
-    c.execute("CREATE INDEX " + table_name + "_data_index ON " + table_name + " (data)")
+    dbindex.append("CREATE INDEX " + table_name + "_data_index ON " + table_name + " (data)")
 
     table_name = dbtable["kanji_radical"]
-    c.execute("CREATE TABLE " + table_name + " (kanji_id INTEGER, radical_id INTEGER)")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (kanji_id,radical_id)")
+    # The primary key follows the kradfile lines (radicals of a kanji) and
+    # the second index the opposite lookup, both contain kanji and radical
+    # so no lookup has to read the table rows
+    c.execute("CREATE TABLE " + table_name + " (kanji_id INTEGER NOT NULL, radical_id INTEGER NOT NULL, PRIMARY KEY (kanji_id, radical_id)) WITHOUT ROWID")
+    dbindex.append("CREATE INDEX " + table_name + "_radical_index ON " + table_name + " (radical_id, kanji_id)")
 
     return database
 
 
-def get_radical_id(radical, database):
-    table_name = dbtable["radicals"]
+def create_indexes(database):
     c = database.cursor()
-    radical_id = 0
 
-    c.execute("SELECT rowid FROM " + table_name + " WHERE data = ?", [radical])
-    row = c.fetchone()
+    with metrics.phase("index"):
+        for query in dbindex:
+            c.execute(query)
+
+    dbindex.clear()
+
 
-    if row is None:
-        c.execute("INSERT INTO " + table_name + " (data) VALUES (?)", [radical])
-        radical_id = c.lastrowid
-    else:
-        radical_id = row[0]
+def close_database(database):
+    # In fast build mode tables are filled without indexes, all of them
+    # are created in a single pass once the data has been imported
+    if dbfile["fastbuild"]:
+        create_indexes(database)
+
+    with metrics.phase("commit"):
+        database.commit()
+    database.close()
+
+    if dbfile["fastbuild"]:
+        os.replace(dbfile["build"], dbfile["name"])
+
+
+def get_radical_id(radical):
+    radical_id = radical_ids.get(radical)
+
+    if radical_id == None:
+        radical_id = len(radical_ids) + 1
+        radical_ids[radical] = radical_id
+        dbrows["radicals"].append((radical_id, radical))
 
     return radical_id
 
 
+def get_kanji_id(kanji):
+    kanji_id = kanji_ids.get(kanji)
+
+    if kanji_id == None:
+        kanji_id = len(kanji_ids) + 1
+        kanji_ids[kanji] = kanji_id
+        dbrows["kanji"].append((kanji_id, kanji))
+
+    return kanji_id
+
+
 def import_data_file(database, kradfile):
-    c = database.cursor()
-    counter = 0
+    counter = metrics.entries
 
-    for line in kradfile:
-        line = line.strip()
+    # The file is small, it is read and decoded all at once and the rows
+    # are only collected here, they are inserted by store_data_rows
+    metrics.set_input(kradfile)
+    with metrics.phase("parse"):
+        lines = kradfile.read().decode("euc-jp").splitlines()
 
-        if line[0] == "#" or line[0] == " ":
-            continue
+        for line in lines:
+            line = line.strip()
 
-        try:
-            kanji,radicals = line.split(":")
-        except:
-            continue
+            if len(line) == 0 or line[0] == "#" or line[0] == " ":
+                continue
 
-        c.execute("INSERT INTO " + dbtable["kanji"] + " (data) VALUES (?)", [line[0]])
-        kanji_id = c.lastrowid
-        
-        for radical in radicals.split():
-            radical_id = get_radical_id(radical.strip(), database)
-            c.execute("INSERT INTO " + dbtable["kanji_radical"] + " (kanji_id, radical_id) VALUES (?, ?)", (kanji_id, radical_id))
+            try:
+                kanji,radicals = line.split(":")
+            except:
+                continue
 
-        counter += 1
-        if not counter % 100:
-            print("#", end = "", flush = True)
+            kanji_id = get_kanji_id(line[0])
 
-    database.commit()
+            for radical in radicals.split():
+                dbrows["kanji_radical"].add((kanji_id, get_radical_id(radical.strip())))
+
+            counter += 1
+            if not counter % 100:
+                metrics.progress(counter, input_position(kradfile))
+
+    metrics.progress(counter, input_position(kradfile), True)
+
+
+def store_data_rows(database):
+    c = database.cursor()
+
+    with metrics.phase("insert"):
+        c.executemany("INSERT INTO " + dbtable["radicals"] + " (rowid, data) VALUES (?, ?)", dbrows["radicals"])
+        c.executemany("INSERT INTO " + dbtable["kanji"] + " (rowid, data) VALUES (?, ?)", dbrows["kanji"])
+        # Pairs found in both files are kept once, they are inserted in
+        # primary key order so the table is filled by appending only
+        c.executemany("INSERT INTO " + dbtable["kanji_radical"] + " (kanji_id, radical_id) VALUES (?, ?)", sorted(dbrows["kanji_radical"]))
+
+    # All the rows are inserted at once, so the indexes are always created
+    # after them and not only with --fastbuild
+    create_indexes(database)
+
+    with metrics.phase("commit"):
+        database.commit()
 
 
 def main():
     args = parse_cmdline()
+    sqltrace.enabled = args.tracesql
     appendtables = False
 
 	# Example query for get the list of radicas of specific kanji
@@ -110,20 +202,26 @@ def main():
     if args.appendtables:
         appendtables = True
 
-    kradfile = codecs.open(args.kradfile, 'r', 'euc-jp')
-    kradfile2 = codecs.open(args.kradfile2, 'r', 'euc-jp')
-    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables)
+    kradfile = open_input(args.kradfile)
+    kradfile2 = open_input(args.kradfile2)
+    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables, args.fastbuild)
 
-    print("Start conversion: ", end = "", flush = True)
+    print("Start conversion: ", end = "\n", flush = True)
 
     import_data_file(database, kradfile)
     import_data_file(database, kradfile2)
+    store_data_rows(database)
 
     print("\nConversion finished")
 
     kradfile.close()
     kradfile2.close()
-    database.close()
+    metrics.count_rows(database, dbtable.values())
+    close_database(database)
+    metrics.report(args.metricsfile)
+    if args.tracesql:
+        sqltrace.report()
+        sqltrace.audit(dbfile["name"], audit_queries, dbtable)
 
     
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+import sqlite3
+
+# Example use:
+#   search = RadkfileSearch("radkfile.db")
+#   kanji = search.find_kanji(["田", "力"])
+#   radicals = search.remaining_radicals(["田", "力"])
+#
+# The radical masks of all the kanji are loaded in memory once, a search is
+# a bitwise AND of every mask with the mask of the requested radicals. If
+# numpy is installed the masks are kept into a 2D array of 64 bit words and
+# the search is vectorized, otherwise python integers are used. The masks
+# can be saved as numpy arrays with save_masks().
+#
+# remaining_radicals returns the radicals that can be added to a selection
+# and still match some kanji, in radkfile order. If the database was built
+# with --cooccurrence single radical selections are answered from the stored
+# masks, otherwise (and for longer selections) the masks of the matching
+# kanji are merged.
+
+class RadkfileSearch:
+    def __init__(self, sqlitefile, prefix="radk", use_numpy=True):
+        if(prefix != ""):
+            prefix += "_"
+
+        self.prefix = prefix
+        self.database = sqlite3.connect(sqlitefile)
+        self.numpy = None
+
+        if use_numpy:
+            try:
+                import numpy
+                self.numpy = numpy
+            except ImportError:
+                pass
+
+        c = self.database.cursor()
+        c.execute("SELECT rowid, data FROM " + self.table("radicals") + " ORDER BY rowid")
+        rows = c.fetchall()
+        self.radicals = dict((data, radical_id) for radical_id, data in rows)
+        self.radical_list = [data for radical_id, data in rows]
+
+        self.all_radicals = None
+        self.cooccurrence = None
+        c.execute("SELECT name FROM sqlite_master WHERE name = ?", [self.table("radical_cooccurrence")])
+        if c.fetchone() != None:
+            c.execute("SELECT radical_id, mask FROM " + self.table("radical_cooccurrence"))
+            self.cooccurrence = dict((radical_id, int.from_bytes(mask, "little")) for radical_id, mask in c.fetchall())
+        c.execute("SELECT mask.kanji_id, kanji.data, mask.mask FROM " + self.table("kanji_mask") + " mask JOIN " +
+                  self.table("kanji") + " kanji ON kanji.rowid = mask.kanji_id ORDER BY mask.kanji_id")
+        rows = c.fetchall()
+
+        self.kanji_ids = [row[0] for row in rows]
+        self.kanji = [row[1] for row in rows]
+        self.mask_size = len(rows[0][2]) if len(rows) > 0 else 0
+
+        if self.numpy != None:
+            # Masks are padded to a multiple of 8 bytes and split into 64 bit
+            # words, word n of all the kanji is stored contiguously in row n
+            # so a search reads only the words having requested radicals
+            self.mask_words = (self.mask_size + 7) // 8
+            data = b"".join(row[2].ljust(self.mask_words * 8, b"\0") for row in rows)
+            masks = self.numpy.frombuffer(data, dtype="<u8").reshape(len(rows), self.mask_words)
+            self.masks = self.numpy.ascontiguousarray(masks.T)
+        else:
+            self.masks = [int.from_bytes(row[2], "little") for row in rows]
+
+    def close(self):
+        self.database.close()
+
+    def table(self, name):
+        return self.prefix + name
+
+    def radical_mask(self, radicals):
+        mask = 0
+
+        for radical in radicals:
+            if radical not in self.radicals:
+                return None
+            mask |= 1 << (self.radicals[radical] - 1)
+
+        return mask
+
+    def match(self, radicals):
+        mask = self.radical_mask(radicals)
+
+        # Returns the indexes into the kanji list of the matching kanji
+        if mask == None:
+            return []
+        if self.numpy != None:
+            words = []
+            for word in range(self.mask_words):
+                value = (mask >> (word * 64)) & 0xFFFFFFFFFFFFFFFF
+                if value == 0:
+                    continue
+                value = self.numpy.uint64(value)
+                words.append((self.masks[word] & value) == value)
+            if len(words) == 0:
+                return list(range(len(self.kanji)))
+            found = words[0]
+            for matches in words[1:]:
+                found &= matches
+            return self.numpy.flatnonzero(found).tolist()
+
+        return [index for index, kanji_mask in enumerate(self.masks) if kanji_mask & mask == mask]
+
+    def find_kanji(self, radicals):
+        return [self.kanji[index] for index in self.match(radicals)]
+
+    def find_kanji_ids(self, radicals):
+        return [self.kanji_ids[index] for index in self.match(radicals)]
+
+    def merge_masks(self, indexes):
+        # Union of the masks of the kanji at the given indexes
+        if self.numpy != None:
+            merged = self.numpy.bitwise_or.reduce(self.masks[:, indexes], axis=1)
+            return sum(int(word) << (index * 64) for index, word in enumerate(merged))
+
+        merged = 0
+        for index in indexes:
+            merged |= self.masks[index]
+        return merged
+
+    def remaining_mask(self, radicals):
+        mask = self.radical_mask(radicals)
+
+        if mask == None:
+            return 0
+        if mask == 0:
+            if self.all_radicals == None:
+                self.all_radicals = self.merge_masks(list(range(len(self.kanji))))
+            return self.all_radicals
+        if self.cooccurrence != None and mask != 0 and mask & (mask - 1) == 0:
+            return self.cooccurrence[mask.bit_length()]
+
+        return self.merge_masks(self.match(radicals))
+
+    def remaining_radicals(self, radicals):
+        selected = self.radical_mask(radicals)
+
+        if selected == None:
+            return []
+        mask = self.remaining_mask(radicals) & ~selected
+
+        return [self.radical_list[bit] for bit in range(mask.bit_length()) if mask >> bit & 1]
+
+    def mask_array(self):
+        import numpy
+
+        # One row of mask_size bytes for every kanji, in the kanji order
+        if self.numpy != None:
+            return numpy.ascontiguousarray(self.masks.T).view(numpy.uint8)[:, :self.mask_size].copy()
+
+        data = b"".join(mask.to_bytes(self.mask_size, "little") for mask in self.masks)
+        return numpy.frombuffer(data, dtype=numpy.uint8).reshape(len(self.masks), self.mask_size).copy()
+
+    def save_masks(self, npzfile):
+        import numpy
+
+        # The saved file has the kanji ids, the kanji characters and the
+        # masks, radical n is bit (n - 1) % 8 of byte (n - 1) // 8
+        numpy.savez(npzfile, kanji_ids=numpy.array(self.kanji_ids, dtype=numpy.int64),
+                    kanji=numpy.array(self.kanji), masks=self.mask_array())
@@ -1,23 +1,50 @@
 
 from argparse import ArgumentParser, FileType, Action
-import sqlite3
 import sys
-import codecs
 import os
+import shutil
+
+# Helpers shared by all the converters, see SQLiteImport.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "SQLiteImport"))
+from SQLiteImport import metrics, sqltrace, fast_build_pragmas, open_input, input_position
+
+# Lookups done by a typical dictionary client, with --tracesql the query
+# plan of each one is checked for full table scans
+audit_queries = [
+    "SELECT rowid FROM {radicals} WHERE data = ?",
+    "SELECT rowid FROM {kanji} WHERE data = ?",
+    "SELECT radical_id FROM {kanji_radical} WHERE kanji_id = ?",
+    "SELECT kanji_id FROM {kanji_radical} WHERE radical_id = ?",
+    "SELECT data FROM {radicals} WHERE stroke_count = ?",
+    "SELECT mask FROM {kanji_mask} WHERE kanji_id = ?",
+    "SELECT mask FROM {radical_cooccurrence} WHERE radical_id = ?"
+    ]
 
 dbtable = dict()
+dbindex = list()
+dbfile = dict()
+
+# Ids of the radicals and kanji already seen and rows waiting to be inserted,
+# ids are assigned here since the tables are always created empty
+radical_ids = dict()
+kanji_ids = dict()
+dbrows = dict(radicals=[], kanji=[], kanji_radical=set())
 
 def parse_cmdline():
     parser = ArgumentParser()
-    parser.add_argument("--radkfile", help="path to the radkfile", default="radkfile")
-    parser.add_argument("--radkfile2", help="path to the radkfile2", default="radkfile2")
+    parser.add_argument("--radkfile", help="path to the radkfile (gzip, xz or bzip2 compressed files are accepted)", default="radkfile")
+    parser.add_argument("--radkfile2", help="path to the radkfile2 (gzip, xz or bzip2 compressed files are accepted)", default="radkfile2")
     parser.add_argument("--sqlitefile", help="path to the sqlite database to create", required=True)
     parser.add_argument("--dbtableprefix", help="prefix of db tables (ex. radk)", default="radk")
     parser.add_argument("--appendtables", help="append tables into an existing database file", action="store_true")
+    parser.add_argument("--fastbuild", "--fast-build", help="build the database with bulk load settings and create indexes at the end", action="store_true")
+    parser.add_argument("--metricsfile", help="write the import metrics (phase times, rows per table, peak memory) to this json file")
+    parser.add_argument("--cooccurrence", help="also store for every radical the mask of the radicals found together with it in some kanji", action="store_true")
+    parser.add_argument("--tracesql", "--trace-sql", help="report the time spent by every sql statement and check the query plans of the common lookups", action="store_true")
     return parser.parse_args()
 
 
-def create_database(name, prefix, append):
+def create_database(name, prefix, append, fastbuild):
     sqlitefile = name
     global dbtable
 
@@ -27,96 +54,196 @@ def create_database(name, prefix, append):
     dbtable["radicals"] = prefix + "radicals"
     dbtable["kanji"] = prefix + "kanji"
     dbtable["kanji_radical"] = prefix + "kanji_radical"
+    dbtable["kanji_mask"] = prefix + "kanji_mask"
+    dbtable["radical_cooccurrence"] = prefix + "radical_cooccurrence"
 
     if len(sqlitefile) < 3 or sqlitefile[-3:] != ".db":
         sqlitefile = sqlitefile + ".db"
 
-    if append == False and os.path.exists(sqlitefile):
+    dbfile["name"] = sqlitefile
+    dbfile["fastbuild"] = fastbuild
+
+    if fastbuild:
+        # Database is built into a temporary file renamed only at the end
+        sqlitefile = sqlitefile + ".tmp"
+        if os.path.exists(sqlitefile):
+            os.remove(sqlitefile)
+        if append == True and os.path.exists(dbfile["name"]):
+            shutil.copyfile(dbfile["name"], sqlitefile)
+    elif append == False and os.path.exists(sqlitefile):
         os.remove(sqlitefile)
 
-    database = sqlite3.connect(sqlitefile)
+    dbfile["build"] = sqlitefile
+    database = sqltrace.connect(sqlitefile)
     c = database.cursor()
 
+    if fastbuild:
+        for pragma in fast_build_pragmas:
+            c.execute(pragma)
+
     table_name = dbtable["radicals"]
     c.execute("CREATE TABLE " + table_name + " (data TEXT NOT NULL, stroke_count INTEGER)")
-    c.execute("CREATE INDEX " + table_name + "_data_index ON " + table_name + " (data)")
-    c.execute("CREATE INDEX " + table_name + "_stroke_count_index ON " + table_name + " (stroke_count)")
+    dbindex.append("CREATE INDEX " + table_name + "_data_index ON " + table_name + " (data)")
+    dbindex.append("CREATE INDEX " + table_name + "_stroke_count_index ON " + table_name + " (stroke_count)")
 
     table_name = dbtable["kanji"]
     c.execute("CREATE TABLE " + table_name + " (data TEXT NOT NULL)")
-    c.execute("CREATE INDEX " + table_name + "_data_index ON " + table_name + " (data)")
+    dbindex.append("CREATE INDEX " + table_name + "_data_index ON " + table_name + " (data)")
 
     table_name = dbtable["kanji_radical"]
-    c.execute("CREATE TABLE " + table_name + " (kanji_id INTEGER, radical_id INTEGER)")
-    c.execute("CREATE INDEX " + table_name + "_id_index ON " + table_name + " (kanji_id,radical_id)")
+    # Every pair is stored once clustered by kanji, the reverse index holds
+    # the whole pair as well, so lookups in both directions are covering
+    c.execute("CREATE TABLE " + table_name + " (kanji_id INTEGER NOT NULL, radical_id INTEGER NOT NULL, PRIMARY KEY (kanji_id, radical_id)) WITHOUT ROWID")
+    dbindex.append("CREATE INDEX " + table_name + "_radical_index ON " + table_name + " (radical_id, kanji_id)")
 
     return database
 
 
-def get_radical_id(radical, stroke_count, database):
-    table_name = dbtable["radicals"]
+def create_indexes(database):
     c = database.cursor()
-    radical_id = 0
 
-    c.execute("SELECT rowid FROM " + table_name + " WHERE data = ?", [radical])
-    row = c.fetchone()
+    with metrics.phase("index"):
+        for query in dbindex:
+            c.execute(query)
 
-    if row is None:
-        c.execute("INSERT INTO " + table_name + " (data, stroke_count) VALUES (?, ?)", (radical, stroke_count))
-        radical_id = c.lastrowid
-    else:
-        radical_id = row[0]
+    dbindex.clear()
 
-    return radical_id
 
+def close_database(database):
+    # In fast build mode tables are filled without indexes, all of them
+    # are created in a single pass once the data has been imported
+    if dbfile["fastbuild"]:
+        create_indexes(database)
 
-def get_kanji_id(kanji, database):
-    table_name = dbtable["kanji"]
-    c = database.cursor()
-    kanji_id = 0
+    with metrics.phase("commit"):
+        database.commit()
+    database.close()
+
+    if dbfile["fastbuild"]:
+        os.replace(dbfile["build"], dbfile["name"])
 
-    c.execute("SELECT rowid FROM " + table_name + " WHERE data = ?", [kanji])
-    row = c.fetchone()
 
-    if row is None:
-        c.execute("INSERT INTO " + table_name + " (data) VALUES (?)", [kanji])
-        kanji_id = c.lastrowid
-    else:
-        kanji_id = row[0]
+def get_radical_id(radical, stroke_count):
+    radical_id = radical_ids.get(radical)
+
+    if radical_id == None:
+        radical_id = len(radical_ids) + 1
+        radical_ids[radical] = radical_id
+        dbrows["radicals"].append((radical_id, radical, stroke_count))
+
+    return radical_id
+
+
+def get_kanji_id(kanji):
+    kanji_id = kanji_ids.get(kanji)
+
+    if kanji_id == None:
+        kanji_id = len(kanji_ids) + 1
+        kanji_ids[kanji] = kanji_id
+        dbrows["kanji"].append((kanji_id, kanji))
 
     return kanji_id
 
 
 def import_data_file(database, datafile):
-    c = database.cursor()
     radical_id = 0
-    counter = 0
+    counter = metrics.entries
+
+    # The file is small, it is read and decoded all at once and the rows
+    # are only collected here, they are inserted by store_data_rows
+    metrics.set_input(datafile)
+    with metrics.phase("parse"):
+        lines = datafile.read().decode("euc-jp").splitlines()
 
-    for line in datafile:
-        line = line.strip()
+        for line in lines:
+            line = line.strip()
 
-        if line[0] == "#" or line[0] == " ":
-            continue
+            if len(line) == 0 or line[0] == "#" or line[0] == " ":
+                continue
 
-        if line[0] == "$":
-            data = line.split()
-            radical_id = get_radical_id(data[1], data[2], database)
-            continue
+            if line[0] == "$":
+                data = line.split()
+                radical_id = get_radical_id(data[1], data[2])
+                continue
 
-        if radical_id > 0:
-            for kanji in line:
-                kanji_id = get_kanji_id(kanji, database)
-                c.execute("INSERT INTO " + dbtable["kanji_radical"] + " (kanji_id, radical_id) VALUES (?, ?)", (kanji_id, radical_id))
+            if radical_id > 0:
+                for kanji in line:
+                    dbrows["kanji_radical"].add((get_kanji_id(kanji), radical_id))
 
-        counter += 1
-        if not counter % 100:
-            print("#", end = "", flush = True)
+            counter += 1
+            if not counter % 100:
+                metrics.progress(counter, input_position(datafile))
 
-    database.commit()
+    metrics.progress(counter, input_position(datafile), True)
+
+
+def store_data_rows(database):
+    c = database.cursor()
+
+    with metrics.phase("insert"):
+        c.executemany("INSERT INTO " + dbtable["radicals"] + " (rowid, data, stroke_count) VALUES (?, ?, ?)", dbrows["radicals"])
+        c.executemany("INSERT INTO " + dbtable["kanji"] + " (rowid, data) VALUES (?, ?)", dbrows["kanji"])
+        # Pairs found in both files are kept once, they are inserted in
+        # primary key order so the table is filled by appending only
+        c.executemany("INSERT INTO " + dbtable["kanji_radical"] + " (kanji_id, radical_id) VALUES (?, ?)", sorted(dbrows["kanji_radical"]))
+
+    # All the rows are inserted at once, so the indexes are always created
+    # after them and not only with --fastbuild
+    create_indexes(database)
+
+    with metrics.phase("commit"):
+        database.commit()
+
+
+def create_kanji_masks(database):
+    table_name = dbtable["kanji_mask"]
+    c = database.cursor()
+
+    # Bit n of the mask is set if the kanji has the radical with rowid n + 1,
+    # bits are stored little endian (first byte has the radicals 1 to 8) and
+    # all the masks have the same size. Kanji having all of a list of radicals
+    # are the ones where mask & radicals_mask == radicals_mask. Masks are
+    # built from the rows collected by import_data_file
+    with metrics.phase("masks"):
+        mask_size = (len(radical_ids) + 7) // 8
+        masks = [0] * (len(kanji_ids) + 1)
+        for kanji_id, radical_id in dbrows["kanji_radical"]:
+            masks[kanji_id] |= 1 << (radical_id - 1)
+
+        c.execute("CREATE TABLE " + table_name + " (kanji_id INTEGER PRIMARY KEY, mask BLOB)")
+        c.executemany("INSERT INTO " + table_name + " (kanji_id, mask) VALUES (?, ?)",
+                      [(kanji_id, masks[kanji_id].to_bytes(mask_size, "little")) for kanji_id in range(1, len(masks))])
+        database.commit()
+
+    return masks
+
+
+def create_radical_cooccurrence(database, masks):
+    table_name = dbtable["radical_cooccurrence"]
+    c = database.cursor()
+
+    # The mask of a radical is the union of the masks of all the kanji having
+    # it, so it has the radicals that can still be selected together with
+    # it (the radical itself included). Same bit layout of the kanji masks
+    with metrics.phase("cooccurrence"):
+        mask_size = (len(radical_ids) + 7) // 8
+        cooccurrence = [0] * (len(radical_ids) + 1)
+        for mask in masks:
+            bits = mask
+            while bits:
+                bit = bits & -bits
+                cooccurrence[bit.bit_length()] |= mask
+                bits ^= bit
+
+        c.execute("CREATE TABLE " + table_name + " (radical_id INTEGER PRIMARY KEY, mask BLOB)")
+        c.executemany("INSERT INTO " + table_name + " (radical_id, mask) VALUES (?, ?)",
+                      [(radical_id, cooccurrence[radical_id].to_bytes(mask_size, "little")) for radical_id in range(1, len(cooccurrence))])
+        database.commit()
 
 
 def main():
     args = parse_cmdline()
+    sqltrace.enabled = args.tracesql
     appendtables = False
 
 	# Example query for get the list of radicas of specific kanji
@@ -127,20 +254,29 @@ def main():
     if args.appendtables:
         appendtables = True
 
-    radkfile = codecs.open(args.radkfile, 'r', 'euc-jp')
-    radkfile2 = codecs.open(args.radkfile2, 'r', 'euc-jp')
-    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables)
+    radkfile = open_input(args.radkfile)
+    radkfile2 = open_input(args.radkfile2)
+    database = create_database(args.sqlitefile.strip(), args.dbtableprefix.strip(), appendtables, args.fastbuild)
 
-    print("Start conversion: ", end = "", flush = True)
+    print("Start conversion: ", end = "\n", flush = True)
 
     import_data_file(database, radkfile)
     import_data_file(database, radkfile2)
+    store_data_rows(database)
+    masks = create_kanji_masks(database)
+    if args.cooccurrence:
+        create_radical_cooccurrence(database, masks)
 
     print("\nConversion finished")
 
     radkfile.close()
     radkfile2.close()
-    database.close()
+    metrics.count_rows(database, dbtable.values())
+    close_database(database)
+    metrics.report(args.metricsfile)
+    if args.tracesql:
+        sqltrace.report()
+        sqltrace.audit(dbfile["name"], audit_queries, dbtable)
 
     
 if __name__ == '__main__':
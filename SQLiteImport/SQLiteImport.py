@@ -0,0 +1,503 @@
+from contextlib import contextmanager
+from collections import defaultdict
+import xml.etree.ElementTree as ET
+import sqlite3
+import sys
+import os
+import json
+import time
+import gzip
+import lzma
+import bz2
+import re
+import unicodedata
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Code shared by all the converters: import metrics (--metricsfile), sql
+# statement trace and query plan audit (--tracesql), the --fastbuild sqlite
+# settings, the batched row writer, the DTD entities, the entries read back
+# from the tables, the normalized readings and the reading of the
+# (optionally compressed) input files. The converters find this module
+# through the SQLiteImport directory next to their own one
+
+# Translation table used for the normalized readings: katakana are folded
+# to hiragana and the long vowel mark is removed. The JMdict and JMnedict
+# importers use normalize_reading for the reb_norm and keb_norm columns and
+# JMdictLookup for the prefix searches
+kana_fold = dict((code, code - 0x60) for code in range(0x30A1, 0x30F7))
+kana_fold[0x30FD] = 0x309D
+kana_fold[0x30FE] = 0x309E
+kana_fold[0x30FC] = None
+
+# SQLite settings used by --fastbuild. Journal and sync are disabled since
+# in this mode the database is built into a temporary file, if import fails
+# the file is simply discarded (page_size must be set before creating tables)
+fast_build_pragmas = [
+    "PRAGMA page_size = 8192",
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -262144",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA locking_mode = EXCLUSIVE"
+    ]
+
+
+class ImportMetrics:
+    # Collect the time spent in every phase of the import, a phase started
+    # while another one is running is not counted in the running one. The
+    # progress line is printed at most every few seconds using the position
+    # into the input file for estimate the remaining time
+    def __init__(self):
+        self.phases = dict()
+        self.running = []
+        self.tables = dict()
+        self.entries = 0
+        self.input_size = 0
+        self.start_time = time.perf_counter()
+        self.last_report = 0
+        self.interactive = sys.stdout.isatty()
+
+    def start(self, name):
+        now = time.perf_counter()
+        if len(self.running) > 0:
+            self.add_time(self.running[-1][0], now - self.running[-1][1])
+        self.running.append([name, now])
+
+    def stop(self):
+        now = time.perf_counter()
+        name, start = self.running.pop()
+        self.add_time(name, now - start)
+        if len(self.running) > 0:
+            self.running[-1][1] = now
+
+    @contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def set_input(self, input_file):
+        self.input_size = os.fstat(input_file.fileno()).st_size
+        self.input_start = time.perf_counter()
+        self.input_entries = self.entries
+
+    def progress(self, entries, offset, force=False):
+        now = time.perf_counter()
+        self.entries = entries
+
+        if now - self.last_report < (1 if self.interactive else 10) and not force:
+            return
+
+        self.last_report = now
+        elapsed = now - self.input_start
+        line = "%d entries, %.0f entries/s" % (entries, (entries - self.input_entries) / elapsed)
+        if self.input_size > 0 and offset > 0:
+            remaining = elapsed * (self.input_size - offset) / offset
+            line += ", %.1f%%, ETA %d:%02d" % (min(offset * 100 / self.input_size, 100), remaining // 60, remaining % 60)
+        print(("\r" if self.interactive else "") + line + "   ", end="" if self.interactive else "\n", flush=True)
+
+    def count_rows(self, database, table_names):
+        c = database.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = set(row[0] for row in c.fetchall())
+
+        for name in table_names:
+            if name in tables and not name.endswith("_fts"):
+                c.execute("SELECT COUNT(*) FROM " + name)
+                self.tables[name] = c.fetchone()[0]
+
+    def peak_rss(self):
+        if resource == None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes while macOS reports bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    def report(self, metricsfile):
+        seconds = time.perf_counter() - self.start_time
+        rows = sum(self.tables.values())
+        peak_rss = self.peak_rss()
+
+        if self.interactive:
+            print()
+        print("Import metrics:")
+        for name, phase_seconds in self.phases.items():
+            print("  %-24s %10.2f s" % (name, phase_seconds))
+        for name, count in self.tables.items():
+            print("  %-24s %10d rows" % (name, count))
+        line = "  %d entries, %d rows in %.2f s (%.0f rows/s)" % (self.entries, rows, seconds, rows / seconds)
+        if peak_rss != None:
+            line += ", peak RSS %.1f MB" % (peak_rss / 1048576)
+        print(line)
+
+        if metricsfile != None:
+            metrics = {
+                "seconds": seconds,
+                "phases": self.phases,
+                "tables": self.tables,
+                "entries": self.entries,
+                "rows": rows,
+                "rows_per_second": rows / seconds,
+                "peak_rss": peak_rss
+                }
+            with open(metricsfile, "w") as file:
+                json.dump(metrics, file, indent=2)
+
+
+metrics = ImportMetrics()
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            sqltrace.add_time(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        finally:
+            sqltrace.add_time(sql, time.perf_counter() - start)
+
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class SqlTrace:
+    # Statements are grouped by template, that is the sql text having all
+    # the literal values replaced by '?'. The trace callback receives every
+    # executed statement (one for each row of an executemany) and is used
+    # for count them while the time is measured by the traced cursor
+    literal = re.compile(r"\b[Xx]'[0-9A-Fa-f]*'|'(?:[^']|'')*'|-?\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b|(?<!NOT )(?<!IS )\bNULL\b")
+    table = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(\w+)", re.IGNORECASE)
+
+    def __init__(self):
+        self.enabled = False
+        self.statements = dict()
+        self.templates = dict()
+
+    def connect(self, sqlitefile):
+        if not self.enabled:
+            return sqlite3.connect(sqlitefile)
+        database = sqlite3.connect(sqlitefile, factory=TracedConnection)
+        database.set_trace_callback(self.trace)
+        return database
+
+    def template(self, sql):
+        if sql not in self.templates:
+            self.templates[sql] = " ".join(self.literal.sub("?", sql).split())
+        return self.templates[sql]
+
+    def statement(self, template):
+        if template not in self.statements:
+            self.statements[template] = [0, 0]
+        return self.statements[template]
+
+    def trace(self, sql):
+        self.statement(" ".join(self.literal.sub("?", sql).split()))[0] += 1
+
+    def add_time(self, sql, seconds):
+        self.statement(self.template(sql))[1] += seconds
+
+    def report(self):
+        tables = dict()
+
+        # Only the slowest statements are listed, all of them are summed
+        # up in the table totals
+        print("SQL statements:")
+        print("  %10s %10s  %s" % ("count", "seconds", "statement"))
+        for index, (template, (count, seconds)) in enumerate(sorted(self.statements.items(), key=lambda item: -item[1][1])):
+            match = self.table.search(template)
+            name = match.group(1) if match else "(none)"
+            if name not in tables:
+                tables[name] = [0, 0]
+            tables[name][0] += count
+            tables[name][1] += seconds
+            if index < 25:
+                print("  %10d %10.3f  %s" % (count, seconds, template if len(template) <= 120 else template[:117] + "..."))
+        if len(self.statements) > 25:
+            print("  %d more statements" % (len(self.statements) - 25))
+
+        print("SQL tables:")
+        print("  %10s %10s  %s" % ("count", "seconds", "table"))
+        for name, (count, seconds) in sorted(tables.items(), key=lambda item: -item[1][1]):
+            print("  %10d %10.3f  %s" % (count, seconds, name))
+
+    def audit(self, sqlitefile, queries, tables):
+        database = sqlite3.connect(sqlitefile)
+        c = database.cursor()
+
+        # A lookup is reported as full scan if any table of the query is
+        # read without searching an index
+        print("Query plan audit:")
+        for query in queries:
+            query = query.format(**tables)
+            try:
+                c.execute("EXPLAIN QUERY PLAN " + query, [None] * query.count("?"))
+            except sqlite3.OperationalError:
+                continue
+            plan = [row[3] for row in c.fetchall()]
+            status = "FULL SCAN" if any(detail.startswith("SCAN ") for detail in plan) else "index"
+            print("  %-9s  %s" % (status, query))
+            for detail in plan:
+                print("  %-9s    %s" % ("", detail))
+
+        database.close()
+
+
+sqltrace = SqlTrace()
+
+
+class RowBuffer:
+    # Collect the parsed rows of every table in memory. The rowid of the
+    # tables having child tables is assigned here instead of by sqlite, in
+    # this way the complete rows can be built before any statement is executed
+    def __init__(self, last_id):
+        self.rows = defaultdict(list)
+        self.last_id = last_id
+
+    def new_id(self, name):
+        self.last_id[name] += 1
+        return self.last_id[name]
+
+    def add(self, name, row):
+        self.rows[name].append(row)
+
+
+class RowWriter(RowBuffer):
+    # Rows are written to each table with a single executemany call about
+    # every batch_size rows. tables maps the names used by the converter to the
+    # database tables, rows of the id_tables have their rowid as first value
+    def __init__(self, database, tables, id_tables, batch_size):
+        RowBuffer.__init__(self, dict())
+        self.database = database
+        self.tables = tables
+        self.id_tables = id_tables
+        self.batch_size = batch_size
+        self.query = dict()
+
+    def new_id(self, name):
+        if name not in self.last_id:
+            self.reserve_ids(name, 0)
+        return RowBuffer.new_id(self, name)
+
+    def reserve_ids(self, name, count):
+        # Skip count ids (assigned by someone else) and return the last id
+        # used before them
+        if name not in self.last_id:
+            c = self.database.cursor()
+            c.execute("SELECT IFNULL(MAX(rowid), 0) FROM " + self.tables[name])
+            self.last_id[name] = c.fetchone()[0]
+        last_id = self.last_id[name]
+        self.last_id[name] += count
+        return last_id
+
+    def flush_full(self):
+        # Called once for every parsed record instead of checking the size
+        # on every added row, so a batch can be a few rows bigger
+        for name, rows in self.rows.items():
+            if len(rows) >= self.batch_size:
+                self.flush(name)
+
+    def flush(self, name=None):
+        if name == None:
+            for name in list(self.rows):
+                self.flush(name)
+            return
+
+        if name not in self.query:
+            self.query[name] = self.insert_query(name)
+        with metrics.phase("insert"):
+            self.database.executemany(self.query[name], self.rows[name])
+        self.rows[name] = []
+
+    def insert_query(self, name):
+        c = self.database.cursor()
+        c.execute("PRAGMA table_info(" + self.tables[name] + ")")
+        columns = [row[1] for row in c.fetchall()]
+        if name in self.id_tables:
+            columns.insert(0, "rowid")
+        return "INSERT INTO " + self.tables[name] + " (" + ", ".join(columns) + ") VALUES (" + ", ".join("?" * len(columns)) + ")"
+
+
+def store_entities(database, table_name, entities):
+    c = database.cursor()
+    c.execute("SELECT code, rowid, description FROM " + table_name)
+    stored = dict((code, (entity_id, description)) for code, entity_id, description in c.fetchall())
+    dtd = dict()
+
+    # Every DTD entity is stored once with its code and full description,
+    # child tables only keep the id of the entity row. The returned dict
+    # maps the expanded entity text to the id
+    for code, description in entities:
+        if code not in stored:
+            c.execute("INSERT INTO " + table_name + " (code, description) VALUES (?, ?)", (code, description))
+            stored[code] = (c.lastrowid, description)
+        elif stored[code][1] != description:
+            c.execute("UPDATE " + table_name + " SET description = ? WHERE rowid = ?", (description, stored[code][0]))
+        dtd[description] = stored[code][0]
+
+    return dtd
+
+
+def read_entries(database, tables, elements, columns, entity_elements, id_table, entry_ids):
+    c = database.cursor()
+    entries = dict()
+    items = dict()
+
+    # tables maps the names of the entry, entity, element and child tables
+    # to the tables present in the database, the missing ones are skipped.
+    # The ids to read are stored in the id_table temp table
+    c.execute("DELETE FROM temp." + id_table)
+    c.executemany("INSERT OR IGNORE INTO temp." + id_table + " (id) VALUES (?)", [(entry_id,) for entry_id in entry_ids])
+
+    c.execute("SELECT rowid, ent_seq FROM " + tables["entry"] + " WHERE rowid IN (SELECT id FROM temp." + id_table + ")")
+    for entry_id, ent_seq in c.fetchall():
+        entries[entry_id] = {"id": entry_id, "ent_seq": ent_seq}
+        for element in elements:
+            if element in tables:
+                entries[entry_id][element] = []
+
+    # Each table is read with one query for the whole batch, rows come in
+    # rowid order so the elements keep the order of the xml file. Since the
+    # sql text never changes, the statements are prepared only once and
+    # then reused from the sqlite3 statement cache
+    for element, children in elements.items():
+        if element not in tables:
+            continue
+        names = columns.get(element, [])
+        children = [child for child in children if element + "_" + child in tables]
+        c.execute("SELECT rowid, entry_id" + "".join(", " + name for name in names) + " FROM " + tables[element] +
+                  " WHERE entry_id IN (SELECT id FROM temp." + id_table + ") ORDER BY rowid")
+        for row in c.fetchall():
+            item = dict(zip(names, row[2:]))
+            for child in children:
+                item[child] = []
+            entries[row[1]][element].append(item)
+            items[(element, row[0])] = item
+
+        for child in children:
+            child_table = tables[element + "_" + child]
+            if child in entity_elements:
+                value = "entity.code FROM " + child_table + " child JOIN " + tables["entity"] + " entity ON entity.rowid = child." + child + "_id"
+            else:
+                value = "child." + child + " FROM " + child_table + " child"
+            c.execute("SELECT child." + element + "_id, " + value +
+                      " JOIN " + tables[element] + " parent ON parent.rowid = child." + element + "_id" +
+                      " WHERE parent.entry_id IN (SELECT id FROM temp." + id_table + ") ORDER BY child.rowid")
+            for parent_id, value in c.fetchall():
+                items[(element, parent_id)][child].append(value)
+
+    return entries
+
+
+def normalize_reading(text):
+    if text == None:
+        return ""
+
+    # NFKC folds half width katakana and full width latin characters
+    return unicodedata.normalize("NFKC", text).translate(kana_fold)
+
+
+def open_input(file):
+    # Compressed files (gzip, xz and bzip2) are recognized by their first
+    # bytes and decompressed while they are read
+    with open(file, "rb") as input_file:
+        magic = input_file.read(6)
+
+    if magic[:2] == b"\x1f\x8b":
+        return gzip.open(file, "rb")
+    if magic == b"\xfd7zXZ\x00":
+        return lzma.open(file, "rb")
+    if magic[:3] == b"BZh":
+        return bz2.open(file, "rb")
+    return open(file, "rb")
+
+
+def input_position(input_file):
+    # Position into the file on disk, for compressed files it is the
+    # amount of compressed data read so far
+    return os.lseek(input_file.fileno(), 0, os.SEEK_CUR)
+
+
+def iter_root_children(context, root):
+    depth = 0
+
+    # Every direct child of the root element is returned as soon as its
+    # end tag has been parsed and then removed from the tree, in this way
+    # memory usage doesn't grow with the size of the xml file
+    for event, item in context:
+        if event == "start":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                yield item
+                root.clear()
+
+
+def parse_xml_dtd(dtd):
+    value_list = []
+    code_list = []
+
+    # Currently the only way I found for extract the xml DTD list
+    # is to manually get entity lines and make a small parsing
+    for line in dtd.decode("utf8").split("\n"):
+        if len(line) >= 15 and line[0:8] == "<!ENTITY":
+            code_list.append(line.split(" ")[1])
+            value_list.append(line.split("\"")[1])
+
+    return list(zip(code_list, value_list))
+
+
+def read_xml_prolog(xml_file, root_tag):
+    start_tag = ("<" + root_tag + ">").encode("utf8")
+    data = b""
+
+    # The prolog is everything before the first record, that is the xml
+    # declaration, the DTD with the entities and the root element tag. It is
+    # read from the same stream used for the records, the data read after it
+    # is returned as well so the file is read once
+    while True:
+        chunk = xml_file.read(65536)
+        data += chunk
+        dtd_end = data.find(b"\n]>")
+        root_start = data.find(start_tag, max(dtd_end, 0))
+        if root_start != -1:
+            root_end = root_start + len(start_tag)
+            entities = parse_xml_dtd(data[:dtd_end]) if dtd_end != -1 else []
+            return entities, data[:root_end], data[root_end:]
+        if not chunk:
+            return [], None, data
+
+
+def iter_xml_events(xml_file, data):
+    parser = ET.XMLPullParser(events=("start", "end"))
+
+    while data:
+        parser.feed(data)
+        yield from parser.read_events()
+        data = xml_file.read(65536)
+
+    parser.close()
+    yield from parser.read_events()